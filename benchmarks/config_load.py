@@ -0,0 +1,50 @@
+'''
+Config load time of the json path against the files written by compile_config.py
+
+    python compile_config.py -c ./config
+    python -m benchmarks.config_load -c ./config
+'''
+import argparse
+import os
+import pathlib
+import time
+
+from compile_config import CONFIGS, compiled_path, load_json, load_config, read_compiled_config
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Config load benchmark')
+
+    parser.add_argument('-c', '--config_path', type=pathlib.Path, help='config file', default='./config')
+    parser.add_argument('-partitions', type=int, help='number of partitions to load', default=8)
+    parser.add_argument('-repeat', type=int, help='runs per measurement, the best one is reported', default=3)
+
+    args = parser.parse_args()
+
+    for name, compile_fn in CONFIGS.items():
+        json_paths = [
+            str(args.config_path / name / partition / f'{name}.json')
+            for partition in sorted(os.listdir(args.config_path / name))
+        ]
+        json_paths = [p for p in json_paths if os.path.exists(compiled_path(p))][:args.partitions]
+        if not json_paths:
+            print(f"{name}: no compiled configs, run compile_config.py first")
+            continue
+
+        results = {
+            'json + compile': best_of(lambda: [compile_fn(load_json(p)) for p in json_paths], args.repeat),
+            'compiled': best_of(lambda: [read_compiled_config(compiled_path(p)) for p in json_paths], args.repeat),
+            'compiled + hash check': best_of(lambda: [load_config(p, compile_fn) for p in json_paths], args.repeat),
+        }
+        for label, seconds in results.items():
+            print(f"{name:5} {label:22} {seconds / len(json_paths) * 1000:8.2f} ms/partition")
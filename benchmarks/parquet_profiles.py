@@ -0,0 +1,74 @@
+'''
+Write throughput, file size and scan time of the PARQUET_PROFILES on a fixed
+sample of one partition
+
+    python -m benchmarks.parquet_profiles -c ./config -partition 2003Q1 -loans 20000
+'''
+import argparse
+import os
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from compile_config import load_config
+from generate_data import LOAN_CHUNK_SIZE
+from loan_aquisition import generate_loans, compile_acq_config
+from loan_performance import generate_perf, compile_perf_config
+from sinks import PARQUET_PROFILES, ParquetSink
+
+
+def sample_partition(config_path, partition, loans):
+    '''
+    The perf rows of the first loans of the partition's first origination month, with a fixed seed
+    '''
+    rng = np.random.default_rng(0)
+    acq_config = load_config(f"{config_path}/acq/{partition}/acq.json", compile_acq_config)
+    perf_conf = load_config(f"{config_path}/perf/{partition}/perf.json", compile_perf_config)
+    orig_date = min(acq_config['loan_cnt_by_date'])
+    year, month = int(orig_date[:4]), int(orig_date[5:7])
+    month_loans = generate_loans(month, year, loans, acq_config, rng=rng)
+    return pa.Table.from_batches([
+        generate_perf(month_loans.slice(start, LOAN_CHUNK_SIZE), perf_conf, rng)
+        for start in range(0, loans, LOAN_CHUNK_SIZE)
+    ])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Parquet write profile benchmark')
+
+    parser.add_argument('-c', '--config_path', type=pathlib.Path, help='config file', default='./config')
+    parser.add_argument('-partition', type=str, help='sample partition', default='2003Q1')
+    parser.add_argument('-loans', type=int, help='loans in the sample', default=20000)
+
+    args = parser.parse_args()
+
+    table = sample_partition(args.config_path, args.partition, args.loans)
+    sample_mb = table.nbytes / (1024 * 1024)
+    loan_id = table.column('loan_id')[table.num_rows // 2].as_py()
+    print(f"{args.partition}: {table.num_rows} perf rows, {sample_mb:.1f} MB in memory")
+    print(f"{'profile':16} {'write MB/s':>10} {'file MB':>8} {'scan s':>7} {'lookup s':>9}")
+
+    for profile in PARQUET_PROFILES:
+        with tempfile.TemporaryDirectory() as output_path:
+            start = time.perf_counter()
+            with ParquetSink(output_path, args.partition, 'perf', profile=profile) as sink:
+                for batch in table.to_batches(max_chunksize=256 * 1024):
+                    sink.write(pa.Table.from_batches([batch]))
+            write_seconds = time.perf_counter() - start
+            sink.commit()
+            file_mb = sum(os.path.getsize(f) for f in sink.file_names) / (1024 * 1024)
+
+            start = time.perf_counter()
+            pq.read_table(sink.file_names)
+            scan_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            pq.read_table(sink.file_names, filters=[('loan_id', '=', loan_id)])
+            lookup_seconds = time.perf_counter() - start
+
+        print(f"{profile:16} {sample_mb / write_seconds:10.1f} {file_mb:8.2f} {scan_seconds:7.3f} {lookup_seconds:9.3f}")
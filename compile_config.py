@@ -0,0 +1,309 @@
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+
+from collections.abc import Mapping
+
+import numpy as np
+import pyarrow as pa
+
+from loan_aquisition import compile_acq_config
+from loan_performance import compile_perf_config
+from utils import WeightedChoice
+
+
+# config/<name>/<partition>/<name>.json and the function compiling it
+CONFIGS = {
+    'acq': compile_acq_config,
+    'perf': compile_perf_config,
+}
+
+# A compiled config is an Arrow IPC file of two record batches of compiled_schema:
+#  - the WeightedChoice tables, every one a slice of the rows with its values in
+#    the column matching the dtype of its values_array (VALUE_COLUMNS)
+#  - the entries of all dicts of the config: (node, key) of the dict and the key,
+#    the kind of the value and the value itself: the child node in int_value for
+#    dicts, the slice of its rows in int_value and float_value for tables, whose
+#    kind is KIND_TABLE[value column]. Node 0 is the config itself.
+# Keys are numbered in sorted order, their list is kept in the schema metadata.
+# Readers map the file and look the values up in place.
+COMPILED_FORMAT = '2'
+compiled_schema = pa.schema([
+    ("str_value", pa.string()),
+    ("float_value", pa.float64()),
+    ("int_value", pa.int64()),
+    ("cum_weight", pa.float64()),
+    ("node", pa.int32()),
+    ("key", pa.int32()),
+    ("kind", pa.int8()),
+])
+VALUE_COLUMNS = {
+    np.dtype(object): 'str_value',
+    np.dtype(np.float64): 'float_value',
+    np.dtype(np.int64): 'int_value',
+}
+KIND_DICT, KIND_FLOAT, KIND_INT, KIND_STR, KIND_BOOL, KIND_NULL = range(6)
+KIND_TABLE = {name: 6 + i for i, name in enumerate(VALUE_COLUMNS.values())}
+TABLE_COLUMNS = {kind: name for name, kind in KIND_TABLE.items()}
+
+
+def load_json(file_path):
+    with open(file_path, 'r') as json_file:
+        data_dict = json.load(json_file)
+    return data_dict
+
+
+def compiled_path(json_path):
+    return os.path.splitext(json_path)[0] + '.arrow'
+
+
+def file_sha256(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def config_entries(config):
+    '''
+    The (node, key, kind, int value, float value, str value) entries of the dicts
+    of a compiled config numbered breadth first, and its WeightedChoice tables.
+    The slices of the tables are set by write_compiled_config
+    '''
+    nodes = [config]
+    tables = []
+    entries = []
+    for node, values in enumerate(nodes):
+        for key, val in values.items():
+            if isinstance(val, dict):
+                nodes.append(val)
+                entries.append((node, key, KIND_DICT, len(nodes) - 1, 0.0, None))
+            elif isinstance(val, WeightedChoice):
+                tables.append(val)
+                entries.append((node, key, None, len(tables) - 1, 0.0, None))
+            elif isinstance(val, bool):
+                entries.append((node, key, KIND_BOOL, int(val), 0.0, None))
+            elif isinstance(val, int):
+                entries.append((node, key, KIND_INT, val, 0.0, None))
+            elif isinstance(val, float):
+                entries.append((node, key, KIND_FLOAT, 0, val, None))
+            elif isinstance(val, str):
+                entries.append((node, key, KIND_STR, 0, 0.0, val))
+            elif val is None:
+                entries.append((node, key, KIND_NULL, 0, 0.0, None))
+            else:
+                raise TypeError(f"can not compile {key}: {type(val).__name__}")
+    return entries, tables
+
+
+def write_compiled_config(compiled, file_path, source_sha256):
+    '''
+    Write a compiled config as an Arrow IPC file, replacing file_path atomically
+    '''
+    entries, tables = config_entries(compiled)
+
+    columns = {name: [] for name in VALUE_COLUMNS.values()}
+    cum_weights = []
+    slices = []
+    start = 0
+    for table in tables:
+        value_col = VALUE_COLUMNS[table.values_array.dtype]
+        n = len(table)
+        for name in VALUE_COLUMNS.values():
+            columns[name].append(table.values_array if name == value_col else np.full(n, None))
+        cum_weights.append(table.cum_weights)
+        slices.append((KIND_TABLE[value_col], start, start + n))
+        start += n
+    table_rows = start
+    # table entries point at their slice
+    for i, (node, key, kind, table, _, _) in enumerate(entries):
+        if kind is None:
+            entries[i] = (node, key, *slices[table], None)
+    keys = sorted({entry[1] for entry in entries})
+    key_ids = {key: i for i, key in enumerate(keys)}
+    entries.sort(key=lambda entry: (entry[0], key_ids[entry[1]]))
+
+    schema = compiled_schema.with_metadata({
+        'format': COMPILED_FORMAT,
+        'source_sha256': source_sha256,
+        'keys': json.dumps(keys),
+    })
+    table_arrays = {
+        name: pa.array(np.concatenate(values) if tables else [], type=schema.field(name).type, from_pandas=True)
+        for name, values in columns.items()
+    }
+    table_arrays['cum_weight'] = pa.array(np.concatenate(cum_weights) if tables else [], type=pa.float64())
+    node, key, kind, int_value, float_value, str_value = zip(*entries) if entries else [()] * 6
+    entry_arrays = {
+        'str_value': pa.array(str_value, type=pa.string()),
+        'float_value': pa.array(float_value, type=pa.float64()),
+        'int_value': pa.array(int_value, type=pa.int64()),
+        'node': pa.array(node, type=pa.int32()),
+        'key': pa.array([key_ids[k] for k in key], type=pa.int32()),
+        'kind': pa.array(kind, type=pa.int8()),
+    }
+
+    tmp_path = f'{file_path}.tmp{os.getpid()}'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            for arrays, n in [(table_arrays, table_rows), (entry_arrays, len(entries))]:
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [arrays.get(field.name, pa.nulls(n, field.type)) for field in schema], schema=schema))
+    os.replace(tmp_path, file_path)
+
+
+class CompiledConfig:
+    '''
+    The memory mapped file of a compiled config. Entries are looked up in the
+    zero copy numpy views of its columns, only the key numbers are held in a dict.
+    '''
+
+    def __init__(self, file_path):
+        reader = pa.ipc.open_file(pa.memory_map(file_path))
+        metadata = reader.schema.metadata
+        self.source_sha256 = metadata[b'source_sha256'].decode()
+        self.keys = json.loads(metadata[b'keys'])
+        self.key_ids = {key: i for i, key in enumerate(self.keys)}
+        self.tables = reader.get_batch(0)
+        self.cum_weights = self.tables.column('cum_weight').to_numpy()
+        entries = reader.get_batch(1)
+        self.node = entries.column('node').to_numpy()
+        self.key = entries.column('key').to_numpy()
+        self.kind = entries.column('kind').to_numpy()
+        self.int_value = entries.column('int_value').to_numpy()
+        self.float_value = entries.column('float_value').to_numpy()
+        self.str_value = entries.column('str_value')
+
+    def value(self, row):
+        kind = self.kind[row]
+        if kind == KIND_DICT:
+            return ConfigNode(self, int(self.int_value[row]))
+        if kind in TABLE_COLUMNS:
+            start, stop = int(self.int_value[row]), int(self.float_value[row])
+            return WeightedChoice.from_arrays(self.tables.column(TABLE_COLUMNS[kind]), self.cum_weights[start:stop],
+                                              start)
+        if kind == KIND_FLOAT:
+            return float(self.float_value[row])
+        if kind == KIND_INT:
+            return int(self.int_value[row])
+        if kind == KIND_STR:
+            return self.str_value[row].as_py()
+        if kind == KIND_BOOL:
+            return bool(self.int_value[row])
+        return None
+
+
+class ConfigNode(Mapping):
+    '''
+    A read only dict of a CompiledConfig. Its values are read from the file on
+    every access, only the dicts and tables it handed out are kept, so a worker
+    only holds the parts of a config it draws from.
+    '''
+
+    def __init__(self, config, node):
+        self._config = config
+        self._start = int(np.searchsorted(config.node, node, side='left'))
+        self._stop = int(np.searchsorted(config.node, node, side='right'))
+        self._children = {}
+
+    def _row(self, key):
+        key_id = self._config.key_ids.get(key)
+        if key_id is not None:
+            row = self._start + int(np.searchsorted(self._config.key[self._start:self._stop], key_id))
+            if row < self._stop and self._config.key[row] == key_id:
+                return row
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if key in self._children:
+            return self._children[key]
+        row = self._row(key)
+        value = self._config.value(row)
+        if not isinstance(value, (float, int, str, bool, type(None))):
+            self._children[key] = value
+        return value
+
+    def __contains__(self, key):
+        try:
+            self._row(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return (self._config.keys[key_id] for key_id in self._config.key[self._start:self._stop])
+
+    def __len__(self):
+        return self._stop - self._start
+
+
+def read_compiled_config(file_path):
+    '''
+    Read a compiled config from its memory mapped Arrow IPC file, as a ConfigNode
+    that looks its values up in the mapping: processes reading the same file
+    share its pages, no json is parsed but the key list.
+    Returns (compiled config, sha256 of the json it was compiled from)
+    '''
+    config = CompiledConfig(file_path)
+    return ConfigNode(config, 0), config.source_sha256
+
+
+def compiled_source_sha256(file_path):
+    '''
+    sha256 of the json a compiled file was compiled from, None for files of an
+    older COMPILED_FORMAT
+    '''
+    metadata = pa.ipc.open_file(pa.memory_map(file_path)).schema.metadata
+    if metadata.get(b'format') != COMPILED_FORMAT.encode():
+        return None
+    return metadata[b'source_sha256'].decode()
+
+
+def compile_config_file(json_path, compile_fn):
+    '''
+    Compile json_path next to it, unless the compiled file is already up to date
+    Returns True if the file was (re)compiled
+    '''
+    source_sha256 = file_sha256(json_path)
+    file_path = compiled_path(json_path)
+    if os.path.exists(file_path) and compiled_source_sha256(file_path) == source_sha256:
+        return False
+    write_compiled_config(compile_fn(load_json(json_path)), file_path, source_sha256)
+    return True
+
+
+def compile_partitions(config_path, partitions=None):
+    '''
+    Compile the acq and perf configs of partitions, all partitions by default
+    '''
+    for name, compile_fn in CONFIGS.items():
+        for partition in sorted(os.listdir(f'{config_path}/{name}')) if partitions is None else partitions:
+            json_path = f'{config_path}/{name}/{partition}/{name}.json'
+            if os.path.exists(json_path) and compile_config_file(json_path, compile_fn):
+                print(f"compiled {json_path}")
+
+
+def load_config(json_path, compile_fn, validate=True):
+    '''
+    The compiled config of json_path: read from its compiled file when that was
+    compiled from the current json, compiled from the json otherwise.
+    Without validate the compiled file is trusted, e.g. by workers of a run that
+    compiled its partitions first (compile_partitions)
+    '''
+    file_path = compiled_path(json_path)
+    if os.path.exists(file_path):
+        source_sha256 = compiled_source_sha256(file_path)
+        if source_sha256 is not None and (not validate or source_sha256 == file_sha256(json_path)):
+            return read_compiled_config(file_path)[0]
+    return compile_fn(load_json(json_path))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compile the acq / perf json configs into Arrow IPC files')
+
+    parser.add_argument('-c', '--config_path', type=pathlib.Path, help='config file', default='./config')
+
+    args = parser.parse_args()
+
+    compile_partitions(args.config_path)
@@ -1,12 +1,23 @@
 import argparse
 import pathlib
 import os
+import sys
 
+import numpy as np
+
+from contextlib import ExitStack
 from datetime import datetime
 from multiprocessing import Pool
 from uuid import uuid4
 
-from generate_data import generate_loan_and_perf
+from generate_data import generate_shard, plan_shards, dataset_path, perf_dataset_path, output_schemas, init_worker
+from generate_data import DEFAULT_SHARD_LOANS, node_shards, node_prefix
+from compile_config import compile_partitions
+from manifest import Manifest, remove_shard_files, merge_manifests, write_json_atomic
+from metrics import RunReport
+from sinks import SINKS, PARQUET_PROFILES, DEFAULT_TARGET_FILE_MB, DERIVED_PARTITION_KEYS, IpcStream
+from sinks import partition_schema, write_dataset_metadata
+from utils import LOAN_ID_TYPES, decoded_schema, max_partition_loans
 
 
 if __name__ == '__main__':
@@ -17,10 +28,61 @@ if __name__ == '__main__':
     parser.add_argument('-end_year', type=int, help='loan acquisition end date', default=2024)
     parser.add_argument('-sf', type=float, help='scale factor', default=0.01)
     parser.add_argument('-sf_name', type=str, help='scale factor', default=str(uuid4()))
-    parser.add_argument('-max_mem_mb', type=int, help='max loans', default=10)
+    parser.add_argument('-max_mem_mb', type=int, default=10,
+                        help='MB of generated rows buffered per worker before they are written, '
+                             'peak RSS per worker is about 2.5 x max_mem_mb + 200 MB')
     parser.add_argument('-o', '--output_path', type=pathlib.Path, help='Output Folder path', default='data')
     parser.add_argument('-c', '--config_path', type=pathlib.Path, help='config file', default='./config')
     parser.add_argument('-pools', type=int, help='number pool', default=1)
+    parser.add_argument('-seed', '--seed', type=int,
+                        help='seed of the per shard random generators, the same seed gives the same data '
+                             'for any -pools; random (and printed) by default')
+    parser.add_argument('-shard_loans', type=int, default=DEFAULT_SHARD_LOANS,
+                        help='quarters are split into shards of about this many (scaled) loans, '
+                             'which are generated longest first. Every shard writes its own files, one per '
+                             'table or per Hive directory of -perf_partition_by, so the file count grows with '
+                             'the shard count: smaller shards keep more workers busy and lose less work to '
+                             '-resume, larger ones write fewer and larger files (the perf of 100k loans is '
+                             'about 40 MB of parquet, well below -target_file_mb)')
+    parser.add_argument('-loan_id_mode', type=str, choices=list(LOAN_ID_TYPES), default='uuid',
+                        help='loan_id as uuid4 strings, partition prefixed int64 counters or 12 digit strings')
+    parser.add_argument('-target_file_mb', type=int, help='size at which output files roll over',
+                        default=DEFAULT_TARGET_FILE_MB)
+    parser.add_argument('-format', type=str, choices=list(SINKS), default='parquet',
+                        help='output format, csv is the pipe delimited Fannie Mae layout')
+    parser.add_argument('-parquet_profile', type=str, choices=list(PARQUET_PROFILES), default='default',
+                        help='parquet write settings, see PARQUET_PROFILES in sinks.py')
+    parser.add_argument('-combined', action='store_true',
+                        help='write one combined table of the perf rows with the acq columns of their loan')
+    parser.add_argument('-perf_partition_by', type=str, nargs='*', default=[],
+                        help='write perf as one Hive partitioned dataset keyed on these columns, '
+                             'e.g. reporting_year zero_balance_code. The key types are only in the '
+                             '_common_metadata of parquet datasets, read them with sinks.hive_partitioning')
+    parser.add_argument('-stream_perf', type=str, metavar='TARGET',
+                        help='stream perf (or combined) as an Arrow IPC stream instead of writing files: '
+                             '"-" for stdout, "unix:<path>" for a unix socket, or a named pipe path')
+    parser.add_argument('-stream_acq', type=str, metavar='TARGET',
+                        help='stream acq as an Arrow IPC stream instead of writing files, see -stream_perf. '
+                             'With both streams, read them concurrently: the run blocks while either '
+                             'reader is behind')
+    parser.add_argument('-resume', '--resume', action='store_true',
+                        help='complete an interrupted run of the same -sf / -sf_name: shards its manifest lists '
+                             'as complete are skipped, the partial files of the others are removed')
+    parser.add_argument('-shard_count', '--shard-count', type=int, default=1,
+                        help='number of nodes generating the dataset together, each with its own -shard_index '
+                             'and the same other arguments')
+    parser.add_argument('-shard_index', '--shard-index', type=int, default=0,
+                        help='the node this run is (0 to shard_count - 1), it writes its share of the shards '
+                             'below the node=<shard_index> folder of the dataset. The Hive partitioned perf '
+                             'dataset of -perf_partition_by is shared by all nodes, their files are disjoint')
+    parser.add_argument('-report', type=str, metavar='PATH',
+                        help='path of the JSON run report: per phase seconds, row and byte counts, rows/s and '
+                             'peak RSS of every worker and shard; _run_report.json in the dataset by default')
+    parser.add_argument('-log_interval', type=float, metavar='SECONDS',
+                        help='print the run totals so far every SECONDS')
+    parser.add_argument('-merge_manifest', '--merge-manifest', action='store_true',
+                        help='once all -shard_count nodes completed, merge their manifests into the dataset '
+                             'manifest instead of generating')
 
     args = parser.parse_args()
 
@@ -32,16 +94,153 @@ if __name__ == '__main__':
     config_path = args.config_path
     max_mem_mb = args.max_mem_mb
     pools = args.pools
+    loan_id_mode = args.loan_id_mode
+    target_file_mb = args.target_file_mb
+    perf_partition_by = args.perf_partition_by
+    combined = args.combined
+    output_format = args.format
+    sink_options = {'profile': args.parquet_profile} if output_format == 'parquet' else {}
+    perf_name = "combined" if combined else "perf"
+    stream_targets = {name: target for name, target in [('acq', args.stream_acq), (perf_name, args.stream_perf)]
+                      if target}
+    if combined and args.stream_acq:
+        parser.error('-stream_acq has no acq table to stream with -combined')
+    if perf_partition_by and args.stream_perf:
+        parser.error('-perf_partition_by and -stream_perf are exclusive')
+    partition_keys = output_schemas(loan_id_mode, combined)[1].names + list(DERIVED_PARTITION_KEYS)
+    unknown_keys = [key for key in perf_partition_by if key not in partition_keys]
+    if unknown_keys:
+        parser.error(f'-perf_partition_by: no {perf_name} column {", ".join(unknown_keys)}')
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error('-shard_index must be between 0 and -shard_count - 1')
+    node = args.shard_index if args.shard_count > 1 else None
+    stdout_to_stderr = '-' in stream_targets.values()
+    if stdout_to_stderr:
+        # stdout carries the stream, progress goes to stderr
+        sys.stdout = sys.stderr
 
-    finished_list = ['1999Q4']
+    if args.merge_manifest:
+        node_prefixes = [node_prefix(i) for i in range(args.shard_count)]
+        try:
+            manifest = merge_manifests(dataset_path(output_path, sf_name, scale), node_prefixes)
+        except ValueError as e:
+            parser.error(str(e))
+        # the nodes share the Hive partitioned perf dataset, its _metadata needs all their files
+        merged_params = manifest.params
+        if merged_params['perf_partition_by'] and merged_params['format'] == 'parquet':
+            merged_perf_name = "combined" if merged_params['combined'] else "perf"
+            merged_schema = output_schemas(merged_params['loan_id_mode'], merged_params['combined'])[1]
+            write_dataset_metadata(perf_dataset_path(output_path, sf_name, scale, merged_perf_name),
+                                   partition_schema(merged_schema, merged_params['perf_partition_by']))
+        sys.exit()
 
-    mapped_args = [
-        (f"{y}Q{q}", output_path, sf_name, config_path, max_mem_mb, scale) 
+    # the settings the files depend on, a run is only resumed with the same ones.
+    # All nodes of a run need the same ones to split the shards the same way
+    params = {
+        'scale': scale, 'shard_loans': args.shard_loans, 'loan_id_mode': loan_id_mode,
+        'target_file_mb': target_file_mb, 'format': output_format, 'sink_options': sink_options,
+        'combined': combined, 'perf_partition_by': perf_partition_by,
+        'start_year': start_year, 'end_year': end_year,
+        'shard_index': args.shard_index, 'shard_count': args.shard_count,
+    }
+    root_path = dataset_path(output_path, sf_name, scale, node)
+    if Manifest.exists(root_path):
+        if not args.resume:
+            parser.error(f'{root_path} holds the dataset of an earlier run, pass -resume to complete it')
+        manifest = Manifest.load(root_path)
+        seed = args.seed if args.seed is not None else manifest.params['seed']
+        params['seed'] = seed
+        if params != manifest.params:
+            parser.error(f'the settings of {root_path} differ: {manifest.params}')
+    else:
+        if node is not None and args.seed is None:
+            parser.error('the nodes of a -shard_count run need the same -seed')
+        seed = args.seed if args.seed is not None else np.random.SeedSequence().entropy
+        params['seed'] = seed
+        manifest = Manifest(root_path, params)
+    print(f"seed = {seed}")
+
+    partitions = [
+        f"{y}Q{q}"
         for y in range(start_year, end_year + 1)
         for q in range(1,5)
-        if f"{y}Q{q}" not in finished_list
     ]
 
-    with Pool(pools) as p:
-        p.starmap(generate_loan_and_perf, mapped_args)
+    # The workers memory map the compiled configs, so all of them share one copy
+    # of every config in the page cache instead of each parsing its own json
+    compile_partitions(config_path, partitions)
+
+    # Loan counts vary by more than 10x between quarters, shards of similar size
+    # handed out longest first keep every worker busy until the end of the run.
+    # The nodes of a -shard_count run split the list without coordination
+    completed = manifest.completed()
+    shards = plan_shards(config_path, partitions, scale, args.shard_loans)
+    # the loan_id counters must not overflow, fail here rather than in the workers
+    partition_loans = {}
+    for shard in shards:
+        partition_loans[shard.partition] = partition_loans.get(shard.partition, 0) + shard.cost
+    largest = max(partition_loans, key=partition_loans.get, default=None)
+    if largest is not None and partition_loans[largest] > max_partition_loans(loan_id_mode):
+        parser.error(f'{largest} has {partition_loans[largest]} loans at -sf {scale}, -loan_id_mode {loan_id_mode} '
+                     f'numbers at most {max_partition_loans(loan_id_mode)} per partition')
+    shards = [shard for shard in node_shards(shards, args.shard_index, args.shard_count)
+              if shard.name not in completed]
+    if completed:
+        print(f"resuming: {len(completed)} shards complete, {len(shards)} to generate")
+    # whatever an interrupted run left of the shards is generated again
+    removed = remove_shard_files(root_path, {shard.name for shard in shards})
+    if node is not None and perf_partition_by:
+        removed += remove_shard_files(perf_dataset_path(output_path, sf_name, scale, perf_name),
+                                      {shard.name for shard in shards})
+    if removed:
+        print(f"removed {removed} partial files")
+    manifest.add_pending(shards)
+    mapped_args = [
+        (shard, output_path, sf_name, config_path, max_mem_mb, scale,
+         loan_id_mode, target_file_mb, perf_partition_by, output_format, sink_options, combined, seed, node)
+        for shard in shards
+    ]
+
+    # Streamed tables are written by the IpcStreams here, their bounded queues
+    # throttle the workers to the pace of the readers
+    schemas = dict(zip(['acq', perf_name], output_schemas(loan_id_mode, combined)))
+    streamed = []
+    with ExitStack() as exit_stack:
+        streams = [
+            exit_stack.enter_context(IpcStream(target, decoded_schema(schemas[name])))
+            for name, target in stream_targets.items()
+        ]
+        queues = {name: stream.queue for name, stream in zip(stream_targets, streams)}
+        # the workers send their metrics during (every log_interval) and after every shard
+        report = exit_stack.enter_context(RunReport(args.log_interval))
+        with Pool(pools, initializer=init_worker,
+                  initargs=(queues, stdout_to_stderr, report.queue, args.log_interval)) as p:
+            # a shard is only complete once the manifest says so
+            for shard, entry in p.imap_unordered(generate_shard, mapped_args):
+                errors = [stream.error for stream in streams if stream.error is not None]
+                if errors:
+                    # the reader is gone, generating the rest would be for nothing
+                    p.terminate()
+                    raise errors[0]
+                if streams:
+                    streamed.append((shard, entry))
+                else:
+                    manifest.commit(shard.name, entry)
+            # let the workers exit on their own, flushing what they put on the queues
+            p.close()
+            p.join()
+
+    # streamed shards are only delivered once their streams were closed without
+    # error, a failed streamed run is generated again in full by -resume
+    for shard, entry in streamed:
+        manifest.commit(shard.name, entry)
+
+    print(report.summary())
+    write_json_atomic(dict(report.to_dict(), params=params, pools=pools),
+                      args.report or f'{root_path}/_run_report.json')
+
+    # a multi-node run writes it in -merge_manifest, once the files of all nodes are in
+    if perf_partition_by and output_format == 'parquet' and node is None:
+        write_dataset_metadata(perf_dataset_path(output_path, sf_name, scale, perf_name),
+                               partition_schema(schemas[perf_name], perf_partition_by))
 
@@ -1,106 +1,511 @@
-
-import json
-
 import pyarrow as pa
-import pyarrow.parquet as pq
 import numpy as np
-import sys
-
-from uuid import uuid4
 
+from collections import deque, namedtuple
+from functools import lru_cache
 from multiprocessing import Pool
 import os
+import sys
+import threading
+import time
+
+from loan_performance import generate_perf, compile_perf_config, combine_acq_perf
+from loan_aquisition import generate_loans, compile_acq_config
+from utils import encoded_acq_schema, encoded_perf_schema, combined_schema
+from utils import LOAN_ID_TYPES, loan_id_base, with_loan_id_type
+from compile_config import load_config
+from metrics import process_metrics, peak_rss_mb
+from sinks import SINKS, HivePartitionedSink, QueueSink, DEFAULT_TARGET_FILE_MB
+
+
+
+# loans generated and turned into perf rows at a time
+LOAN_CHUNK_SIZE = 1000
+# loans per shard, see partition_shards
+DEFAULT_SHARD_LOANS = 100_000
+# rows per batch of iter_batches
+DEFAULT_BATCH_ROWS = 64 * 1024
+# partitions whose configs a worker keeps loaded, see worker_partition_configs
+CONFIG_CACHE_PARTITIONS = 4
+
+class Shard(namedtuple('Shard', ['partition', 'number', 'loan_ranges', 'cost'])):
+    '''
+    A unit of work of datagen.py: the (year, month, start, stop) loan ranges of a
+    partition's origination months that are generated together and written to
+    files labeled name, cost is the number of loans. loan_ranges None is the
+    whole partition.
+    '''
+    __slots__ = ()
 
-from loan_performance import generate_perf
-from loan_aquisition import generate_loan
-from utils import acq_headers, acq_schema, perf_schema
+    @property
+    def name(self):
+        return f"{self.partition}_{self.number}"
 
+    def rng(self, seed):
+        '''
+        The np.random.Generator of the shard, derived from the run's seed by the
+        partition and shard number alone, so the data of a shard is the same no
+        matter which worker generates it and when
+        '''
+        year, quarter = self.partition.split('Q')
+        seed_sequence = np.random.SeedSequence(seed, spawn_key=(int(year) * 10 + int(quarter), self.number))
+        return np.random.default_rng(seed_sequence)
 
+# IpcStream queues of the streamed tables by name, set in the workers by init_worker
+stream_queues = {}
+# the queue of the RunReport of the main process and the seconds between the
+# updates a worker sends it during a shard (None: only once it is complete)
+metrics_reporting = {'queue': None, 'interval': None}
 
-def load_json(file_path):
-    with open(file_path, 'r') as json_file:
-        data_dict = json.load(json_file)
-    return data_dict
 
-def save_data(data, schema, output_path, partition, name, num):
+def init_worker(queues, stdout_to_stderr=False, report_queue=None, report_interval=None):
+    '''
+    Pool initializer: the tables named in queues are handed to the IpcStreams of
+    the main process instead of being written to files. With stdout_to_stderr
+    prints go to stderr, as stdout carries a stream. The process_metrics of the
+    worker are sent to report_queue (see report_metrics).
+    '''
+    stream_queues.update(queues)
+    metrics_reporting.update(queue=report_queue, interval=report_interval)
+    if stdout_to_stderr:
+        sys.stdout = sys.stderr
 
-    
-    
-    pyarrow_table = pa.Table.from_arrays([pa.array(col) for col in zip(*data)], schema=schema)
-    file_name = f'{output_path}/{name}/{name}_{partition}_{num}.parquet'
-    pq.write_table(pyarrow_table, file_name, compression='ZSTD')
-    del pyarrow_table
-    
 
-def generate_loan_and_perf(partition, output_path, sf_name, config_path, max_mem_mb, scale=1):
-    print(f"Starting partition = {partition}")
+def report_metrics(shard=None):
+    '''
+    Send what process_metrics recorded since the last report to the RunReport,
+    shard is the {name, seconds, rows} summary of a completed shard
+    '''
+    if metrics_reporting['queue'] is not None:
+        metrics_reporting['queue'].put((os.getpid(), peak_rss_mb(), process_metrics.take(), shard))
 
-    output_path = f'{output_path}/sf={scale}_{sf_name}/{partition}'
 
-    if not os.path.isdir(output_path):
+class BackgroundWriter:
+    '''
+    Writes tables to their sinks on a separate thread, so Parquet encoding and
+    compression (which release the GIL) overlap with generating the next batches.
+
+    The tables waiting for or being written by the thread are bounded to
+    max_pending_bytes: write() blocks until enough of them are written, a table
+    larger than that on its own is let through once nothing else is pending.
+    An error of the thread is raised by the next write() or by close().
+    '''
+
+    def __init__(self, max_pending_bytes):
+        self.max_pending_bytes = max_pending_bytes
+        self._pending = deque()
+        self._pending_bytes = 0
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                sink, table = self._pending[0]
+            try:
+                if self._error is None:
+                    sink.write(table)
+            except BaseException as e:
+                self._error = e
+            with self._cond:
+                self._pending.popleft()
+                self._pending_bytes -= table.nbytes
+                self._cond.notify_all()
+
+    def write(self, sink, table):
+        with self._cond:
+            while self._pending and self._pending_bytes + table.nbytes > self.max_pending_bytes and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            self._pending.append((sink, table))
+            self._pending_bytes += table.nbytes
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
         try:
-            os.makedirs(f'{output_path}/acq')
-            os.makedirs(f'{output_path}/perf')
-        except Exception as e:
-            print(f"Error creating directory: {e}")
+            self.close()
+        except BaseException:
+            if exc_type is None:
+                raise
+
+
+def save_data(batches, schema, sink, writer):
+    with process_metrics.timer('arrow_conversion'):
+        table = pa.Table.from_batches(batches, schema=schema)
+    writer.write(sink, table)
 
+
+def output_schemas(loan_id_mode='uuid', combined=False):
+    '''
+    The (acq, perf) schemas of the generated batches, perf is the combined schema with combined
+    '''
+    acq_schema = with_loan_id_type(encoded_acq_schema, LOAN_ID_TYPES[loan_id_mode])
+    perf_schema = with_loan_id_type(encoded_perf_schema, LOAN_ID_TYPES[loan_id_mode])
+    if combined:
+        perf_schema = combined_schema(perf_schema, acq_schema)
+    return acq_schema, perf_schema
+
+
+def load_partition_configs(config_path, partition, validate=True):
+    '''
+    The (acq, perf) configs of partition, None if it has no configs.
+    validate as in load_config
+    '''
     perf_config_path = f"{config_path}/perf/{partition}"
     acq_config_path = f"{config_path}/acq/{partition}"
-    # print(f"perf_config_path = {perf_config_path}")
     if not os.path.exists(perf_config_path) or not os.path.exists(acq_config_path):
-        print("not existing...")
-        return
+        return None
+    # compiled by compile_config.py, or compiled here if that is missing or stale
+    acq_config = load_config(f"{acq_config_path}/acq.json", compile_acq_config, validate)
+    perf_conf = load_config(f"{perf_config_path}/perf.json", compile_perf_config, validate)
+    return acq_config, perf_conf
 
-    perf_conf = load_json(f"{perf_config_path}/perf.json")
-    acq_config = load_json(f"{acq_config_path}/acq.json")
-    loans = []
-    perfs = []
-    loan_cnt = 0
-    perf_cnt = 0
-    memory_size = 0
+
+@lru_cache(maxsize=CONFIG_CACHE_PARTITIONS)
+def worker_partition_configs(config_path, partition):
+    '''
+    load_partition_configs for the shards of a pool worker: the shards of a
+    partition share one load, and the compiled files are trusted as datagen.py
+    compiled them before starting the pool
+    '''
+    return load_partition_configs(config_path, partition, validate=False)
+
+
+def origination_months(acq_config, scale=1):
+    '''
+    Yields (year, month, scaled loan count) of the origination months of an acq config, in generation order
+    '''
     for year in range(1999, 2025):
         for month in range(1, 13):
             orig_date = f"{year}-{month:02d}-01"
-            # print(f"orig_date = {orig_date}")
             if "loan_cnt_by_date" not in acq_config or orig_date not in acq_config['loan_cnt_by_date']:
                 continue
+            # loan count based on the loan count distribution in the original dataset
+            yield year, month, int(acq_config['loan_cnt_by_date'][orig_date] * scale)
+
+
+def generate_chunks(partition, acq_config, perf_conf, rng, scale=1, loan_id_mode='uuid', combined=False,
+                    loan_ranges=None):
+    '''
+    The generation engine of a partition: yields (loans, perf) RecordBatches of
+    LOAN_CHUNK_SIZE loans and their perf rows, or the combined rows as perf with
+    combined. The loans of one origination month are generated at a time, all
+    values are drawn from the np.random.Generator rng.
+
+    loan_ranges limits generation to the (year, month, start, stop) loan ranges
+    of a Shard, loan_ids are numbered as if the whole partition was generated.
+    '''
+    if loan_ranges is not None:
+        month_ranges = {}
+        for year, month, start, stop in loan_ranges:
+            month_ranges.setdefault((year, month), []).append((start, stop))
+    first_loan_num = loan_id_base(partition, loan_id_mode)
+    for year, month, scaled_loan_cnt in origination_months(acq_config, scale):
+        ranges = [(0, scaled_loan_cnt)] if loan_ranges is None else month_ranges.get((year, month), [])
+        for start, stop in ranges:
+            with process_metrics.timer('loan_sampling'):
+                month_loans = generate_loans(month, year, stop - start, acq_config, first_loan_num + start,
+                                             loan_id_mode, rng)
+            for chunk_start in range(0, stop - start, LOAN_CHUNK_SIZE):
+                chunk = month_loans.slice(chunk_start, LOAN_CHUNK_SIZE)
+                with process_metrics.timer('perf_generation'):
+                    trans = generate_perf(chunk, perf_conf, rng)
+                    if combined:
+                        trans = combine_acq_perf(chunk, trans)
+                yield chunk, trans
+        first_loan_num += scaled_loan_cnt
+
+
+def partition_shards(partition, acq_config, scale=1, shard_loans=DEFAULT_SHARD_LOANS):
+    '''
+    Split a partition into Shards of shard_loans loans: origination months
+    larger than that are split into loan ranges, smaller ones are packed together
+    (a partition smaller than shard_loans is a single shard). The cost of a shard
+    is its loan count.
+    '''
+    shards = []
+    ranges = []
+    loans = 0
+    for year, month, loan_cnt in origination_months(acq_config, scale):
+        start = 0
+        while start < loan_cnt:
+            stop = min(loan_cnt, start + shard_loans - loans)
+            ranges.append((year, month, start, stop))
+            loans += stop - start
+            start = stop
+            if loans == shard_loans:
+                shards.append(Shard(partition, len(shards), tuple(ranges), loans))
+                ranges = []
+                loans = 0
+    if ranges or not shards:
+        shards.append(Shard(partition, len(shards), tuple(ranges), loans))
+    return shards
+
+
+def plan_shards(config_path, partitions, scale=1, shard_loans=DEFAULT_SHARD_LOANS):
+    '''
+    The Shards of partitions, longest (highest cost) first, so the stragglers
+    start early and the short shards fill the workers up at the end of a run.
+    Partitions without config are kept as a single shard without loans.
+    '''
+    shards = []
+    for partition in partitions:
+        configs = load_partition_configs(config_path, partition)
+        if configs is None:
+            shards.append(Shard(partition, 0, (), 0))
+        else:
+            shards.extend(partition_shards(partition, configs[0], scale, shard_loans))
+    return sorted(shards, key=lambda shard: shard.cost, reverse=True)
+
 
-            # Generate loan based on the loan count distribution in the original dataset
-            scaled_loan_cnt = int(acq_config['loan_cnt_by_date'][orig_date] * scale)
-            for i in range(scaled_loan_cnt):
-                loan_id = str(uuid4())
-                acq_dict = generate_loan(month, year, loan_id, acq_config)
-                loans.append([acq_dict[key] if key in acq_dict else None for key in acq_headers])
-                trans = generate_perf(acq_dict, perf_conf)
-                perfs.extend(trans)
-                loan_cnt += 1
-                perf_cnt += len(trans)
-
-                if loan_cnt % 1000 == 0:
-                    memory_size = sys.getsizeof(perfs)
-                    memory_size += sys.getsizeof(loans)
-                    # print(f"mem = {memory_size / (1024*1024)}mb")
+def node_shards(shards, node, node_count):
+    '''
+    The shards of the plan_shards list that node (0 to node_count - 1) generates.
+    Every shard goes to the node with the least cost so far (the lowest numbered
+    on ties), so the nodes get about the same cost and every node computes the
+    same split from the same list without talking to the others.
+    '''
+    costs = [0] * node_count
+    selected = []
+    for shard in shards:
+        target = min(range(node_count), key=lambda i: (costs[i], i))
+        costs[target] += shard.cost
+        if target == node:
+            selected.append(shard)
+    return selected
+
+
+def rebatch(pending, batch, batch_rows):
+    '''
+    Add batch to the pending batches, yield every batch_rows rows of them as one batch
+    '''
+    pending_rows = sum(b.num_rows for b in pending)
+    while batch.num_rows:
+        rows = min(batch.num_rows, batch_rows - pending_rows)
+        pending.append(batch.slice(0, rows))
+        batch = batch.slice(rows)
+        pending_rows += rows
+        if pending_rows == batch_rows:
+            yield pa.concat_batches(pending) if len(pending) > 1 else pending[0]
+            pending.clear()
+            pending_rows = 0
+
+
+def iter_batches(partitions, scale=1, seed=None, batch_rows=DEFAULT_BATCH_ROWS, config_path='./config',
+                 loan_id_mode='uuid', combined=False):
+    '''
+    Generate partitions in process, lazily yielding (name, RecordBatch) with name
+    "acq" and "perf" ("combined" only, with combined). Every batch has batch_rows
+    rows except the last one of each table, so memory stays bounded by a few
+    batches plus one origination month of loans. The batches have the encoded
+    output_schemas (dictionary and run-end encoded columns), decode_columns turns
+    them into plain columns for consumers without support for those.
+
+    Every partition is drawn from the rng of its Shard 0 for seed, so with the
+    same seed the batches are the same as the files of datagen.py when the
+    partition is not split into several shards. Without a seed the batches
+    differ on every call.
+
+        for name, batch in iter_batches(['2000Q1'], scale=0.01, seed=0):
+            ...
+    '''
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    perf_name = "combined" if combined else "perf"
+    pending = {name: [] for name in (['acq'] if not combined else []) + [perf_name]}
+    for partition in partitions:
+        configs = load_partition_configs(config_path, partition)
+        if configs is None:
+            raise ValueError(f"no acq / perf config for partition {partition} in {config_path}")
+        rng = Shard(partition, 0, None, 0).rng(seed)
+        for chunk, trans in generate_chunks(partition, *configs, rng, scale, loan_id_mode, combined):
+            for name, batch in zip(pending, [chunk, trans] if not combined else [trans]):
+                for full_batch in rebatch(pending[name], batch, batch_rows):
+                    yield name, full_batch
+    for name, batches in pending.items():
+        if batches:
+            yield name, pa.concat_batches(batches)
+
+
+def dataset_path(output_path, sf_name, scale, node=None):
+    '''
+    The folder of a dataset, or of the part node generates of it (see node_shards)
+    '''
+    path = f'{output_path}/sf={scale}_{sf_name}'
+    return path if node is None else f'{path}/{node_prefix(node)}'
+
+
+def node_prefix(node):
+    return f'node={node}'
+
+
+def perf_dataset_path(output_path, sf_name, scale, name="perf", node=None):
+    return f'{dataset_path(output_path, sf_name, scale, node)}/{name}'
+
+
+def generate_loan_and_perf(shard, output_path, sf_name, config_path, max_mem_mb, scale=1, loan_id_mode='uuid',
+                           target_file_mb=DEFAULT_TARGET_FILE_MB, perf_partition_by=None, output_format='parquet',
+                           sink_options=None, combined=False, seed=0, node=None):
+    '''
+    Generate the acq and perf data of one Shard (see plan_shards), into files
+    labeled with its name in its partition's folders. Generated batches are buffered
+    until their Arrow size reaches max_mem_mb and then written as one row group
+    (or stripe / record batch block) by the output_format sink of SINKS, created
+    with sink_options (e.g. the parquet profile).
+
+    With perf_partition_by, perf is written into the Hive partitioned dataset at
+    perf_dataset_path keyed on those columns instead of the partition's perf folder.
+    All nodes write into the one dataset, the files of a shard carry its name.
+
+    With combined, a single "combined" table is written instead of acq and perf:
+    the perf rows with the acq columns of their loan (combine_acq_perf).
+
+    The data is drawn from the shard's rng for seed (see Shard.rng), the same
+    seed gives the same files no matter how many workers generate the shards.
+    With node, the other files go below the node's prefix of the dataset (see
+    node_shards), their manifest paths are relative to it.
+
+    Tables with a queue in stream_queues (see init_worker) are not written to
+    files but streamed by the main process.
+
+    The files are written under temporary names and renamed once all of them are
+    complete (FileSink.commit). Returns the shard's Manifest entry: the rows
+    generated per table and the records of its files, with paths relative to the
+    dataset.
+
+    A BackgroundWriter thread writes the flushed row groups while the next ones
+    are generated, with up to max_mem_mb of them in flight.
+
+    The phases, rows and bytes of the shard are recorded in process_metrics and
+    reported to the main process every metrics_reporting interval and at the end
+    (see report_metrics).
+
+    Peak RSS of a worker stays within about 2.5 x max_mem_mb on top of a fixed
+    ~200 MB (interpreter, config, one origination month of loans and the working
+    arrays of one perf chunk); measured on 2003Q1 at sf=0.2 with 10 / 50 / 200 MB
+    budgets: 235 / 340 / 653 MB.
+    '''
+    partition = shard.partition
+    print(f"Starting shard = {shard.name}")
+    start_time = last_report = time.perf_counter()
+
+    perf_name = "combined" if combined else "perf"
+    perf_path = perf_dataset_path(output_path, sf_name, scale, perf_name)
+    root_path = dataset_path(output_path, sf_name, scale, node)
+    output_path = f'{root_path}/{partition}'
+
+    # the shards of a partition share its folders
+    try:
+        if not combined and 'acq' not in stream_queues:
+            os.makedirs(f'{output_path}/acq', exist_ok=True)
+        if not perf_partition_by and perf_name not in stream_queues:
+            os.makedirs(f'{output_path}/{perf_name}', exist_ok=True)
+    except Exception as e:
+        print(f"Error creating directory: {e}")
+
+    entry = {'partition': partition, 'rows': {}, 'bytes': 0, 'files': []}
+    configs = worker_partition_configs(config_path, partition)
+    if configs is None:
+        print("not existing...")
+        return entry
+
+    rng = shard.rng(seed)
+    acq_schema, perf_schema = output_schemas(loan_id_mode, combined)
+    loans = []
+    perfs = []
+    memory_size = 0
+    rows = {'acq': 0, perf_name: 0}
+    # one open writer per table, every flush below is a row group. The writer
+    # thread is closed first, once all its pending row groups are written
+    sink_class = SINKS[output_format]
+    sink_options = sink_options or {}
+    if perf_name in stream_queues:
+        perf_sink = QueueSink(stream_queues[perf_name])
+    elif perf_partition_by:
+        perf_sink = HivePartitionedSink(os.path.dirname(perf_path), shard.name, perf_name, perf_partition_by,
+                                        target_file_mb, sink_class, **sink_options)
+    else:
+        perf_sink = sink_class(output_path, shard.name, perf_name, target_file_mb, **sink_options)
+    if 'acq' in stream_queues:
+        acq_sink = QueueSink(stream_queues['acq'])
+    else:
+        acq_sink = sink_class(output_path, shard.name, "acq", target_file_mb, **sink_options)
+    with acq_sink, perf_sink:
+        with BackgroundWriter(1024*1024*max_mem_mb) as writer:
+            for chunk, trans in generate_chunks(partition, *configs, rng, scale, loan_id_mode, combined,
+                                                shard.loan_ranges):
+                loans.append(chunk)
+                perfs.append(trans)
+                rows['acq'] += chunk.num_rows
+                rows[perf_name] += trans.num_rows
+                if not combined:
+                    process_metrics.count('acq_rows', chunk.num_rows)
+                process_metrics.count(f'{perf_name}_rows', trans.num_rows)
+                process_metrics.count('arrow_bytes', chunk.nbytes + trans.nbytes)
+                if metrics_reporting['interval'] and \
+                        time.perf_counter() - last_report >= metrics_reporting['interval']:
+                    report_metrics()
+                    last_report = time.perf_counter()
+
+                # the Arrow bytes referenced by the buffered batches
+                memory_size += chunk.nbytes + trans.nbytes
+                # print(f"mem = {memory_size / (1024*1024)}mb")
 
                 if memory_size > 1024*1024*max_mem_mb:
-                    print(f"saving tables for {partition} - chunks {memory_size / (1024*1024)}mb")
-                    save_data(loans, acq_schema, output_path, partition, "acq", loan_cnt)
+                    print(f"saving tables for {shard.name} - chunks {memory_size / (1024*1024)}mb")
+                    if not combined:
+                        save_data(loans, acq_schema, acq_sink, writer)
                     loans = []
-                    save_data(perfs, perf_schema, output_path, partition, "perf", perf_cnt)                   
+                    save_data(perfs, perf_schema, perf_sink, writer)
                     perfs = []
                     memory_size = 0
-                    print(f"saved tables for {partition} - chunks {memory_size / (1024*1024)}mb")
-                    
-
-    if len(loans) > 0 and len(perfs) > 0:
-        # print("saving remaining tables")
-        # print(f"perf to {output_path}/perf/perf_{partition}.parquet")
-        save_data(perfs, perf_schema, output_path, partition, "perf", perf_cnt)
-        del perfs
-
-        # print(f"acq to {output_path}/acq/acq_{partition}.parquet")
-        save_data(loans, acq_schema, output_path, partition, "acq", loan_cnt)
-        del loans
-        print(f"finised {partition}")
-        # Append partition to a local file
-    with open(f"sf={scale}_{sf_name}finished_file.txt", "a") as file:
-        file.write(f"'{partition}',\n")
+                    print(f"saved tables for {shard.name} - chunks {memory_size / (1024*1024)}mb")
+
+            if len(loans) > 0 and len(perfs) > 0:
+                save_data(perfs, perf_schema, perf_sink, writer)
+                del perfs
+
+                if not combined:
+                    save_data(loans, acq_schema, acq_sink, writer)
+                del loans
+                print(f"finised {shard.name}")
+
+        # every row group is written, give the files their names
+        with process_metrics.timer('commit'):
+            files = acq_sink.commit() + perf_sink.commit()
+
+    if combined:
+        del rows['acq']
+    entry['rows'] = rows
+    entry['bytes'] = sum(file['bytes'] for file in files)
+    entry['files'] = [dict(file, path=os.path.relpath(file['path'], root_path)) for file in files]
+    process_metrics.count('written_bytes', entry['bytes'])
+    process_metrics.count('written_files', len(files))
+    report_metrics({'name': shard.name, 'seconds': time.perf_counter() - start_time, 'rows': rows})
+    return entry
+
+
+def generate_shard(args):
+    '''
+    (shard, generate_loan_and_perf(*args)), for Pool.imap_unordered
+    '''
+    return args[0], generate_loan_and_perf(*args)
@@ -1,75 +1,177 @@
 import math
-import random
 
-from datetime import datetime
+import numpy as np
+import pyarrow as pa
 
-from utils import discrete_cols, norm_cols, data_types, generate_random_within_range, get_random_choice
+from utils import discrete_cols, norm_cols, data_types, acq_schema, truncated_normal, group_indices, WeightedChoice
+from utils import month_index, month_index_to_date32, encoded_acq_schema, dictionary_array, conform
+from utils import LOAN_ID_TYPES, generate_loan_ids, with_loan_id_type
 
 
-def column_is_null(orig_date, seller_name, col, acq_config):
-    if col in acq_config['missing_rate'][seller_name]:
-        return acq_config['missing_rate'][seller_name][col] > random.random()
-    return False
-
-def generate_col_from_distribution(name, orig_date, seller_name, acq_config):
-    if column_is_null(orig_date, seller_name, name, acq_config):
-        return None
-    else:
-        keys_and_weights = acq_config['distribution'][seller_name][f"{name}_weight"]
-        val = get_random_choice(keys_and_weights)
-        if name in data_types and data_types[name] == 'int':
-            if val == 'NaN':
-                return None
-            if val == "":
-                return None
-            return int(float(val))
-        return val
-
+def is_string_col(name):
+    return pa.types.is_string(acq_schema.field(name).type)
 
 
-def generate_col_from_normal_distribution(name, orig_date, seller_name,acq_config):
-    if column_is_null(orig_date, seller_name, name, acq_config):
+def discrete_value_converter(name):
+    '''
+    Convert a raw acq.json value the way generate_col_from_distribution always did:
+    int columns are parsed from their float string, "" means missing.
+    '''
+    if name not in data_types or data_types[name] != 'int':
         return None
-    else:
-        stats = acq_config['col_norm_distribution'][orig_date][seller_name]
-        # print(f"stats ={stats}")
-        mean = stats[f"{name}_mean"]
-        std = stats[f"{name}_std"]
-        min_value = stats[f"{name}_min"]
-        max_value = stats[f"{name}_max"]
-
-        if not mean or math.isnan(mean):
-            return None
-
-        val  = generate_random_within_range(mean, std, min_value, max_value)
-
-        if name in data_types and data_types[name] == 'int':
-            if val == 'NaN':
-                return None
-            if val == "":
-                print(name)
-            return float(int(round(val)))
-        return val
-
-def generate_loan(orig_month, orig_year, loan_id, acq_config):
 
+    def convert(val):
+        if val == "":
+            return None
+        val = int(float(val))
+        return str(val) if is_string_col(name) else val
+    return convert
+
+
+def compile_acq_config(acq_config):
+    '''
+    Compile the weight dicts of an acq.json config into WeightedChoice tables.
+    Done once per partition, the rest of the config is kept as is.
+    Discrete column values are converted to their output type at compile time.
+    '''
+    compiled = dict(acq_config)
+    compiled['seller_distribution_daily'] = {
+        orig_date: WeightedChoice(weights)
+        for orig_date, weights in acq_config['seller_distribution_daily'].items()
+    }
+    compiled['distribution'] = {}
+    for seller_name, cols in acq_config['distribution'].items():
+        compiled['distribution'][seller_name] = {}
+        for col_weight, weights in cols.items():
+            name = col_weight[:-len("_weight")]
+            compiled['distribution'][seller_name][col_weight] = WeightedChoice(
+                weights,
+                convert=discrete_value_converter(name),
+                dtype=object if is_string_col(name) else np.float64,
+            )
+    return compiled
+
+
+def column_is_null(orig_date, seller_name, col, acq_config, n, rng):
+    if col in acq_config['missing_rate'][seller_name]:
+        return acq_config['missing_rate'][seller_name][col] > rng.random(n)
+    return np.zeros(n, dtype=bool)
+
+
+def generate_col_from_distribution(name, orig_date, seller_name, acq_config, n, rng):
+    '''
+    Draw n values of a discrete column for one seller,
+    returns (WeightedChoice table, indices of the drawn values, nulls)
+    '''
+    weights = acq_config['distribution'][seller_name][f"{name}_weight"]
+    indices = weights.sample_indices(n, rng)
+    nulls = column_is_null(orig_date, seller_name, name, acq_config, n, rng)
+    return weights, indices, nulls
+
+
+def generate_col_from_normal_distribution(name, orig_date, seller_name, acq_config, n, rng):
+    '''
+    Draw n values of a normally distributed column for one seller, returns (values, nulls)
+    '''
+    nulls = column_is_null(orig_date, seller_name, name, acq_config, n, rng)
+    stats = acq_config['col_norm_distribution'][orig_date][seller_name]
+    # print(f"stats ={stats}")
+    mean = stats[f"{name}_mean"]
+    std = stats[f"{name}_std"]
+    min_value = stats[f"{name}_min"]
+    max_value = stats[f"{name}_max"]
+
+    if not mean or math.isnan(mean):
+        return np.full(n, np.nan), np.ones(n, dtype=bool)
+
+    values = truncated_normal(mean, std, min_value, max_value, n, rng)
+
+    if name in data_types and data_types[name] == 'int':
+        values = np.round(values)
+    return values, nulls
+
+
+def to_arrow(values, nulls, field_type):
+    if values.dtype != object:
+        nulls = nulls | np.isnan(values)
+    return pa.array(values, mask=nulls, type=field_type)
+
+
+def generate_loans(orig_month, orig_year, n, acq_config, first_loan_num=0, loan_id_mode='uuid', rng=None):
+    '''
+    Generate all n loans of an origination month as an encoded_acq_schema RecordBatch,
+    with loan_id of loan_id_mode counting up from first_loan_num (see generate_loan_ids).
+    Every value is drawn from the np.random.Generator rng, a fresh one by default.
+
+    Sellers are sampled first, then the loans are grouped by seller and every
+    discrete_cols / norm_cols value and missing-rate mask is drawn as an array
+    for the whole seller group.
+
+    The draws go straight into typed column buffers allocated for the month:
+    float64 values for numeric columns, and for string columns indices into a
+    dictionary made of the value tables of the drawn sellers, so no Python
+    string objects are created per loan.
+    '''
     orig_date = f"{orig_year}-{orig_month:02d}-01"
-
-    first_pay_month = orig_month + 2 if orig_month + 2 <= 12 else (orig_month + 2) % 12
-    first_pay_year = orig_year + (orig_month + 2) // 12
-    seller_name_weight = acq_config['seller_distribution_daily'][orig_date]
-    seller_name = get_random_choice(seller_name_weight)
-
-    cols_dict = {}
-    cols_dict['seller_name'] = seller_name
-    cols_dict['loan_id'] = loan_id
-    cols_dict['origination_date'] = datetime.strptime(orig_date, "%Y-%m-%d").date()
-    cols_dict['first_payment_date'] = datetime.strptime(f"{first_pay_year}-{first_pay_month}-01", "%Y-%m-%d").date()
-
-    for col in discrete_cols:
-        cols_dict[col] = generate_col_from_distribution(col, orig_date, seller_name, acq_config)
-
-    for col in norm_cols:
-        cols_dict[col] = generate_col_from_normal_distribution(col, orig_date, seller_name, acq_config)
-
-    return cols_dict
\ No newline at end of file
+    origination_month = month_index(orig_year, orig_month)
+
+    seller_weight = acq_config['seller_distribution_daily'][orig_date]
+    rng = np.random.default_rng(rng)
+    seller_idx = seller_weight.sample_indices(n, rng)
+
+    values = {}
+    indices = {}
+    dictionaries = {}
+    dictionary_size = {}
+    nulls = {}
+    for col in discrete_cols + norm_cols:
+        if is_string_col(col):
+            indices[col] = np.empty(n, dtype=np.int32)
+            dictionaries[col] = []
+            dictionary_size[col] = 0
+        else:
+            values[col] = np.empty(n, dtype=np.float64)
+        nulls[col] = np.zeros(n, dtype=bool)
+
+    for s, rows in group_indices(seller_idx):
+        seller_name = seller_weight.values[s]
+        for col in discrete_cols:
+            weights, idx, nulls[col][rows] = generate_col_from_distribution(col, orig_date, seller_name, acq_config, len(rows), rng)
+            if col in indices:
+                indices[col][rows] = dictionary_size[col] + idx
+                dictionaries[col].append(weights.arrow_values.cast(pa.string()))
+                dictionary_size[col] += len(weights)
+            else:
+                values[col][rows] = weights.values_array[idx]
+        for col in norm_cols:
+            values[col][rows], nulls[col][rows] = generate_col_from_normal_distribution(col, orig_date, seller_name, acq_config, len(rows), rng)
+
+    columns = {}
+    for col, dictionary in dictionaries.items():
+        dictionary = pa.concat_arrays(dictionary) if dictionary else pa.array([], type=pa.string())
+        # values missing in acq.json ("") are null in the dictionary
+        nulls[col] |= dictionary.is_null().to_numpy(zero_copy_only=False)[indices[col]]
+        # one dictionary entry per distinct value across the sellers' tables
+        distinct = dictionary.dictionary_encode()
+        distinct_indices = distinct.indices.fill_null(0).to_numpy()[indices[col]]
+        columns[col] = dictionary_array(distinct.dictionary, distinct_indices, nulls[col])
+    for col in values:
+        columns[col] = to_arrow(values[col], nulls[col], acq_schema.field(col).type)
+
+    schema = with_loan_id_type(encoded_acq_schema, LOAN_ID_TYPES[loan_id_mode])
+    arrays = []
+    for field in schema:
+        if field.name == 'loan_id':
+            arrays.append(generate_loan_ids(first_loan_num, n, loan_id_mode, rng))
+        elif field.name == 'seller_name':
+            arrays.append(dictionary_array(seller_weight.values, seller_idx))
+        elif field.name == 'origination_date':
+            arrays.append(month_index_to_date32(np.full(n, origination_month)))
+        elif field.name == 'first_payment_date':
+            arrays.append(month_index_to_date32(np.full(n, origination_month + 2)))
+        elif field.name in columns:
+            arrays.append(conform(columns[field.name], field.type))
+        else:
+            arrays.append(pa.nulls(n, type=field.type))
+
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
@@ -1,16 +1,75 @@
-import random
 import math
-import sys
 
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+import numpy as np
+import pyarrow as pa
 
-from utils import get_random_choice, generate_random_within_range, data_types
+from utils import truncated_normal, data_types, encoded_perf_schema, group_indices, group_by_value, WeightedChoice
+from utils import month_index, month_index_to_date32, date32_to_month_index
+from utils import dictionary_array, run_end_constant, conform, with_loan_id_type, combined_schema
 
 
-LAST_LOAN_REPORTING_DATE = datetime.strptime("2023-06-01", '%Y-%m-%d').date()
+LAST_LOAN_REPORTING_MONTH = month_index(2023, 6)
 
-def generate_col_from_normal_distribution_perf(name, perf_conf):
+DEFAULT_MSA = WeightedChoice({'00000': 1})
+DEFAULT_ZERO_BALANCE_CODE = WeightedChoice({"01": 1})
+
+# How the performance rows of a loan look, by zero_balance_code. All other codes are NON_PERFORMING
+CURRENT, PREPAID, THIRD_PARTY_SALE, REPURCHASED, NON_PERFORMING = range(5)
+LOAN_KINDS = {
+    "": CURRENT,
+    "01": PREPAID,
+    "02": THIRD_PARTY_SALE,
+    "03": THIRD_PARTY_SALE,
+    "09": THIRD_PARTY_SALE,
+    "15": THIRD_PARTY_SALE,
+    "06": REPURCHASED,
+    "16": NON_PERFORMING,
+}
+
+# current_loan_delinquency_status by code: 00-99 months delinquent, then XX
+STATUS_XX = 100
+STATUS_VALUES = [f"{s:02d}" for s in range(100)] + ["XX"]
+STATUS_BYTES = np.frombuffer("".join(STATUS_VALUES[:100]).encode(), dtype=np.uint8).reshape(100, 2)
+
+# loan_payment_history covers the status of the last 24 months
+HISTORY_MONTHS = 24
+HISTORY_VALUES = pa.array(["00" * HISTORY_MONTHS, ""])
+HISTORY_ALL_CURRENT, HISTORY_EMPTY = range(2)
+FLAG_VALUES = pa.array(["N", "Y"])
+
+NEVER = np.iinfo(np.int64).max // 4
+
+terminal_normal_cols = [
+    'foreclosure_costs',
+    'credit_enhancement_proceeds',
+    'repurchase_make_whole_proceeds',
+    'other_foreclosure_proceeds',
+    'modification_noninterest_bearing_upb',
+    'principal_foregiveness_amount',
+]
+
+
+def compile_perf_config(perf_conf):
+    '''
+    Compile the weight dicts of a perf.json config into WeightedChoice tables.
+    Done once per partition, col_norm_distribution is kept as is.
+    '''
+    compiled = dict(perf_conf)
+    for key in ['zero_balance_code_distribution', 'servicer']:
+        compiled[key] = {k: WeightedChoice(weights) for k, weights in perf_conf[key].items()}
+    for key in ['loan_age_distribution', 'delinquency_distribution']:
+        compiled[key] = {
+            k: WeightedChoice(weights, convert=lambda val: int(float(val)), dtype=np.int64)
+            for k, weights in perf_conf[key].items()
+        }
+    compiled['msa'] = {
+        state: {zip_code: WeightedChoice(weights) for zip_code, weights in zips.items()}
+        for state, zips in perf_conf['msa'].items()
+    }
+    return compiled
+
+
+def generate_col_from_normal_distribution_perf(name, perf_conf, n, rng):
 
     stats = perf_conf['col_norm_distribution']
     # print(f"stats ={stats}")
@@ -20,15 +79,13 @@ def generate_col_from_normal_distribution_perf(name, perf_conf):
     max_value = stats[f"{name}_max"]
 
     if not mean or math.isnan(mean):
-        return None
+        return np.full(n, np.nan)
 
-    val  = generate_random_within_range(mean, std, min_value, max_value)
+    values = truncated_normal(mean, std, min_value, max_value, n, rng)
 
     if name in data_types and data_types[name] == 'int':
-        if val == 'NaN':
-            return None
-        return float(int(round(val)))
-    return val
+        values = np.round(values)
+    return values
 
 
 
@@ -36,553 +93,262 @@ def get_last_loan_status():
     return 10
 
 
-
-def generate_perf_data_for_current_loan(loan, perf_conf, zero_balance_code=""):
+def per_loan_dictionary(values, loan, nulls=None):
     '''
-    For a current loan, there are several options:
-     1) the reporting month is up to "current": '2023-06-01'
-     2) current_loan_delinquency_status: 
-        - The majority status is non-delinquent: 00
-        - some loans have 1 or 2 delingquent
-        - very very few loans has more than 3 delinquent
-        - TODO: they may have delingquent in the middle, which is ignored in this simulation
+    Dictionary column of the distinct per-loan values, indexed by the loan of every row
     '''
-    trans = []
-    loan_id = loan['loan_id']
-    interest_rate = loan['original_interest_rate']
-    orig_date = loan['origination_date']
-    seller_name = loan['seller_name']
-    loan_term = loan['original_loan_term']
-    reporting_month = orig_date + relativedelta(months=1)
-    maturity_date = orig_date + relativedelta(months=loan_term)
-
-    # The loan payment will go to the LAST_LOAN_REPORTING_DATE
-    max_loan_age = max((LAST_LOAN_REPORTING_DATE - orig_date).days // 30, 1)
-    delingquent_num_weights = perf_conf["delinquency_distribution"][zero_balance_code]
-    last_loan_status = int(float(get_random_choice(delingquent_num_weights)))
-    current_loan_delinquency_status = 0
-
-    msa_weight = perf_conf['msa'][loan['property_state']].get(str(loan['zip']), {'00000': 1})
-    servicer_weight = perf_conf['servicer'][seller_name]
-
-    msa = get_random_choice(msa_weight)
-    servicer = get_random_choice(servicer_weight)
-
-    # upb
-    upb_skip = random.choices([1,2,3])[0]
-    monthly_upb = loan['original_upb']/loan_term
-    current_actual_upb = loan['original_upb']
-
-    loan_payment_history = [0]*24
-
-    for i in range(0, max_loan_age):
-
-        trans.append(
-            [
-                loan_id,
-                reporting_month, # reporting month
-                servicer, # servicer
-                "", #master_servicer
-                float(interest_rate) if interest_rate else None, # current_interest_rate
-                None if upb_skip > 0 else max(0, round(current_actual_upb, 1)) , # current_upb
-                i, # loan_age
-                loan_term, # remaining_months_to_legal_maturity
-                loan_term - 1, # remaining_months_to_maturity
-                maturity_date,
-                msa, # msa
-                f"{current_loan_delinquency_status:02d}", # current_loan_delinquency_status
-                "".join([f"{s:02d}"for s in loan_payment_history]), #loan_payment_history
-                "Y" if random.random() < 0.01 else "N", # modification_flag
-                "", #mortgage_insurance_cancellation_flag
-                zero_balance_code, #zero_balance_code
-                None, #zero_balance_effective_date
-                None, #'last_paid_installment_date',
-                None, #'foreclosure_date',
-                None, # 'disposition_date',
-                None, # 'foreclosure_costs',
-                None, #'credit_enhancement_proceeds',
-                None, #'repurchase_make_whole_proceeds',
-                None, # 'other_foreclosure_proceeds',
-                None, # modification_noninterest_bearing_upb',
-                None, #'principal_foregiveness_amount',
-                None, #'repurchase_make_whole_proceeds_flag',
-                None, #'borrower_credit_score_current',
-                None, #'coborrower_credit_score_current',
-                None, #'foreclosure_principal_writeoff_amount',
-                None, #'next_interest_rate_adjustment_date',
-                None, #'next_payment_change_date'
-            ]
-        )
-        reporting_month += relativedelta(months=1)
-        loan_term -= 1
-        upb_skip -= 1
-        if upb_skip <= 0:
-            current_actual_upb -= monthly_upb
-        
-        if i + last_loan_status + 2 > max_loan_age:
-                current_loan_delinquency_status += 1
-                current_actual_upb += monthly_upb
-                current_loan_delinquency_status = min(current_loan_delinquency_status, 99)
-
-        loan_payment_history = loan_payment_history[1: ] +  [current_loan_delinquency_status]
-
-        if i > loan_term or current_actual_upb <=0:
-            break
-        
-    return trans
-
-
-def generate_perf_data_for_prepaid_loan(loan, perf_conf, zero_balance_code="01"):
+    uniques, inverse = np.unique(values, return_inverse=True)
+    return dictionary_array(uniques, inverse[loan], nulls)
+
+
+def encode_payment_history(i, delinquent_from):
     '''
-    For a prepaid or matured loan, there are several options:
-     1) the loan was prepaid or matured
-     2) last loan_delinquency_status: 
-        - XX, some of them are 00
-        - the last upb is set to 0
-        - repurchase_make_whole_proceeds_flag is N
-        - zero_balance_code is the last reporting month
-     3) need sample a loan age
-     4) TODO: it may default in the middle
+    loan_payment_history of rows i of loans delinquent from month delinquent_from,
+    built directly as a fixed width 48 character Arrow string array
     '''
+    months = i[:, None] - (HISTORY_MONTHS - 1) + np.arange(HISTORY_MONTHS) - delinquent_from[:, None]
+    data = STATUS_BYTES[np.clip(months, 0, 99)]
+    offsets = np.arange(len(i) + 1, dtype=np.int32) * 2 * HISTORY_MONTHS
+    return pa.Array.from_buffers(pa.string(), len(i), [None, pa.py_buffer(offsets), pa.py_buffer(data.tobytes())])
 
-    trans = []
-    loan_id = loan['loan_id']
-    interest_rate = loan['original_interest_rate']
-    orig_date = loan['origination_date']
-    seller_name = loan['seller_name']
-    loan_term = loan['original_loan_term']
-    reporting_month = orig_date + relativedelta(months=1)
-    maturity_date = orig_date + relativedelta(months=loan_term)
-
-    weights = perf_conf["loan_age_distribution"][zero_balance_code]
-    max_loan_age = max(int(float(get_random_choice(weights))), 1)
-
-    msa_weight = perf_conf['msa'][loan['property_state']].get(str(loan['zip']), {'00000': 1})
-    servicer_weight = perf_conf['servicer'][seller_name]
-
-    msa = get_random_choice(msa_weight)
-    servicer = get_random_choice(servicer_weight)
-
-    # upb
-    upb_skip = random.choices([1,2,3])[0]
-    monthly_upb = loan['original_upb']/loan_term
-    current_actual_upb = loan['original_upb']
-
-    loan_payment_history = "".join([f"{s:02d}"for s in [0]*24])
-
-    for i in range(0, max_loan_age - 1):
-
-        trans.append(
-            [
-                loan['loan_id'],
-                reporting_month, # reporting month
-                servicer, # servicer
-                "", #master_servicer
-                float(interest_rate) if interest_rate else None, # current_interest_rate
-                None if upb_skip > 0 else max(0, round(current_actual_upb, 1)) , # current_upb
-                i, # loan_age
-                loan_term, # remaining_months_to_legal_maturity
-                loan_term - 1, # remaining_months_to_maturity
-                maturity_date,
-                msa, # msa
-                "00", # current_loan_delinquency_status
-                loan_payment_history, #loan_payment_history
-                "Y" if random.random() < 0.01 else "N", # modification_flag
-                "", #mortgage_insurance_cancellation_flag
-                "", #zero_balance_code
-                None, #zero_balance_effective_date
-                None, #'last_paid_installment_date',
-                None, #'foreclosure_date',
-                None, # 'disposition_date',
-                None, # 'foreclosure_costs',
-                None, #'credit_enhancement_proceeds',
-                None, #'repurchase_make_whole_proceeds',
-                None, # 'other_foreclosure_proceeds',
-                None, # modification_noninterest_bearing_upb',
-                None, #'principal_foregiveness_amount',
-                None, #'repurchase_make_whole_proceeds_flag',
-                None, #'borrower_credit_score_current',
-                None, #'coborrower_credit_score_current',
-                None, #'foreclosure_principal_writeoff_amount',
-                None, #'next_interest_rate_adjustment_date',
-                None, #'next_payment_change_date'
-            ]
-        )
-        reporting_month += relativedelta(months=1)
-        loan_term -= 1
-        upb_skip -= 1
-        if upb_skip <= 0:
-            current_actual_upb -= monthly_upb
-        
-        if i > loan_term or current_actual_upb <=0:
-            break
-
-    if random.random() < 0.05: # TODO: Should have a ratio
-        last_delingquent = "00"
-    else:
-        last_delingquent = "XX"
-
-    trans.append(
-        [
-            loan_id,
-            reporting_month, # reporting month
-            None, # servicer
-            "", #master_servicer
-            None, # current_interest_rate
-            0.0 , # current_upb
-            None, # loan_age
-            None, # remaining_months_to_legal_maturity
-            None, # remaining_months_to_maturity
-            None,
-            msa, # msa
-            last_delingquent, # current_loan_delinquency_status
-            None, #loan_payment_history
-            None, # modification_flag
-            "", #mortgage_insurance_cancellation_flag
-            zero_balance_code, #zero_balance_code
-            reporting_month, #zero_balance_effective_date
-            None, #'last_paid_installment_date',
-            None, #'foreclosure_date',
-            None, # 'disposition_date',
-            None, # 'foreclosure_costs',
-            None, #'credit_enhancement_proceeds',
-            None, #'repurchase_make_whole_proceeds',
-            None, # 'other_foreclosure_proceeds',
-            None, # modification_noninterest_bearing_upb',
-            None, #'principal_foregiveness_amount',
-            "N",  #'repurchase_make_whole_proceeds_flag',
-            None, #'borrower_credit_score_current',
-            None, #'coborrower_credit_score_current',
-            None, #'foreclosure_principal_writeoff_amount',
-            None, #'next_interest_rate_adjustment_date',
-            None, #'next_payment_change_date'
-        ]
-    )
-
-        
-    return trans
-
-
-def generate_perf_data_for_3rd_party_sale_loan(loan, perf_conf, zero_balance_code="02"):
+
+def loan_rows(row_cnt):
     '''
-    For a 3rd party sale loan after N defaults:
-     1) sample a number of loan age and delingquencies: 
-        - last delingquent number is XX, vew few of them are the number of del
-        - the last upb is set to 0
-        - zero_balance_code is 02
-        - zero_balance_effective_date is last reporting month
-        - ┃ last_paid_installment_date 
-        - ┃ foreclosure_date  ┃ disposition_date last reporting month
-        - ┃ foreclosure_costs ┃ credit_enhancement_proceeds ┃ repurchase_make_whole_proceeds ┃ other_foreclosure_proceeds
-        - repurchase_make_whole_proceeds_flag is "N"
-     4) TODO: it may default in the middle
+    For loans with row_cnt rows each: the loan of every row and the row's 0-based index within its loan
     '''
+    row_cnt = np.maximum(row_cnt, 0)
+    loan = np.repeat(np.arange(len(row_cnt)), row_cnt)
+    starts = np.cumsum(row_cnt) - row_cnt
+    return loan, np.arange(len(loan)) - starts[loan]
+
 
-    trans = []
-    loan_id = loan['loan_id']
-    interest_rate = loan['original_interest_rate']
-    orig_date = loan['origination_date']
-    seller_name = loan['seller_name']
-    loan_term = loan['original_loan_term']
-    reporting_month = orig_date + relativedelta(months=1)
-    maturity_date = orig_date + relativedelta(months=loan_term)
-
-    weights = perf_conf["loan_age_distribution"][zero_balance_code]
-    max_loan_age = max(int(float(get_random_choice(weights))), 1)
-    delingquent_num_weights = perf_conf["delinquency_distribution"][zero_balance_code]
-    delingquent_num = int(float(get_random_choice(delingquent_num_weights)))
-    current_loan_delinquency_status = 0
-
-    msa_weight = perf_conf['msa'][loan['property_state']].get(str(loan['zip']), {'00000': 1})
-    servicer_weight = perf_conf['servicer'][seller_name]
-
-    msa = get_random_choice(msa_weight)
-    servicer = get_random_choice(servicer_weight)
-
-    # upb
-    upb_skip = random.choices([1,2,3])[0]
-    monthly_upb = loan['original_upb']/loan_term
-    current_actual_upb = loan['original_upb']
-
-    loan_payment_history = [0]*24
-    last_payment_date = None
-
-    for i in range(0, max_loan_age - 1):
-
-        trans.append(
-            [
-                loan_id,
-                reporting_month, # reporting month
-                servicer, # servicer
-                "", #master_servicer
-                float(interest_rate) if interest_rate else None, # current_interest_rate
-                None if upb_skip > 0 else max(0, round(current_actual_upb, 1)) , # current_upb
-                i, # loan_age
-                loan_term, # remaining_months_to_legal_maturity
-                loan_term - 1, # remaining_months_to_maturity
-                maturity_date,
-                msa, # msa
-                f"{current_loan_delinquency_status:02d}", # current_loan_delinquency_status
-                "".join([f"{s:02d}"for s in loan_payment_history]), #loan_payment_history
-                "Y" if random.random() < 0.01 else "N", # modification_flag
-                "", #mortgage_insurance_cancellation_flag
-                "", #zero_balance_code
-                None, #zero_balance_effective_date
-                None, #'last_paid_installment_date',
-                None, #'foreclosure_date',
-                None, # 'disposition_date',
-                None, # 'foreclosure_costs',
-                None, #'credit_enhancement_proceeds',
-                None, #'repurchase_make_whole_proceeds',
-                None, # 'other_foreclosure_proceeds',
-                None, # modification_noninterest_bearing_upb',
-                None, #'principal_foregiveness_amount',
-                None, #'repurchase_make_whole_proceeds_flag',
-                None, #'borrower_credit_score_current',
-                None, #'coborrower_credit_score_current',
-                None, #'foreclosure_principal_writeoff_amount',
-                None, #'next_interest_rate_adjustment_date',
-                None, #'next_payment_change_date'
-            ]
-        )
-        reporting_month += relativedelta(months=1)
-        loan_term -= 1
-        upb_skip -= 1
-        if upb_skip <= 0:
-            current_actual_upb -= monthly_upb
-        if i + delingquent_num + 2 > max_loan_age:
-                if not last_payment_date:
-                     last_payment_date = reporting_month - relativedelta(months=1)
-                current_loan_delinquency_status += 1
-                current_actual_upb += monthly_upb
-                current_loan_delinquency_status = min(current_loan_delinquency_status, 99)
-
-        loan_payment_history = loan_payment_history[1:] + [current_loan_delinquency_status]
-
-        if i > loan_term or current_actual_upb <=0:
-            break
-
-    if zero_balance_code in ["02", "09", "15"] and random.random() < 0.05:
-        last_delingquent = f"{delingquent_num:02d}"
-    else:
-        last_delingquent = "XX"
-
-    trans.append(
-        [
-            loan_id,
-            reporting_month, # reporting month
-            None, # servicer
-            "", #master_servicer
-            interest_rate, # current_interest_rate
-            0.0 , # current_upb
-            None, # loan_age
-            None, # remaining_months_to_legal_maturity
-            None, # remaining_months_to_maturity
-            None,
-            msa, # msa
-            last_delingquent, # current_loan_delinquency_status
-            None, #loan_payment_history
-            None, # modification_flag
-            "", #mortgage_insurance_cancellation_flag
-            zero_balance_code, #zero_balance_code
-            reporting_month, #zero_balance_effective_date
-            last_payment_date, #'last_paid_installment_date',
-            reporting_month, #'foreclosure_date',
-            reporting_month, # 'disposition_date',
-            generate_col_from_normal_distribution_perf('foreclosure_costs', perf_conf), # 'foreclosure_costs',
-            generate_col_from_normal_distribution_perf('credit_enhancement_proceeds', perf_conf), #'credit_enhancement_proceeds',
-            generate_col_from_normal_distribution_perf('repurchase_make_whole_proceeds', perf_conf), #'repurchase_make_whole_proceeds',
-            generate_col_from_normal_distribution_perf('other_foreclosure_proceeds', perf_conf), # 'other_foreclosure_proceeds',
-            generate_col_from_normal_distribution_perf('modification_noninterest_bearing_upb', perf_conf), # modification_noninterest_bearing_upb',
-            generate_col_from_normal_distribution_perf('principal_foregiveness_amount', perf_conf), #'principal_foregiveness_amount',
-            "N", #'repurchase_make_whole_proceeds_flag',
-            None, #'borrower_credit_score_current',
-            None, #'coborrower_credit_score_current',
-            None, #'foreclosure_principal_writeoff_amount',
-            None, #'next_interest_rate_adjustment_date',
-            None, #'next_payment_change_date'
-        ]
-    )
-   
-    return trans
-
-
-def generate_perf_data_for_repurchased_loan(loan, perf_conf, zero_balance_code="02"):
+def sample_perf_outcomes(loans, perf_conf, rng):
     '''
-    For a Repurchased loan:
-     1) sample a number of loan age: 
-        - last delingquent number is XX
-        - the last upb is set to 0
-        - zero_balance_code is 06
-        - zero_balance_effective_date is last reporting month
-        - repurchase_make_whole_proceeds_flag is "Y"
-     4) TODO: it may default in the middle
+    Sample the outcome of every loan of an acq batch:
+        - zero_balance_code, from the credit score bin
+        - max_loan_age, current loans run until LAST_LOAN_REPORTING_MONTH
+        - delinquent_num, the number of delinquent months at the end (current and 3rd party sale loans)
+        - msa and servicer
+        - upb_skip, the number of months before current_upb is reported
     '''
-
-    trans = []
-    loan_id = loan['loan_id']
-    interest_rate = loan['original_interest_rate']
-    orig_date = loan['origination_date']
-    seller_name = loan['seller_name']
-    loan_term = loan['original_loan_term']
-    reporting_month = orig_date + relativedelta(months=1)
-    maturity_date = orig_date + relativedelta(months=loan_term)
-
-    weights = perf_conf["loan_age_distribution"][zero_balance_code]
-    max_loan_age = max(int(float(get_random_choice(weights))), 1)
-
-    msa_weight = perf_conf['msa'][loan['property_state']].get(str(loan['zip']), {'00000': 1})
-    servicer_weight = perf_conf['servicer'][seller_name]
-
-    msa = get_random_choice(msa_weight)
-    servicer = get_random_choice(servicer_weight)
-
-    # upb
-    upb_skip = random.choices([1,2,3])[0]
-    monthly_upb = loan['original_upb']/loan_term
-    current_actual_upb = loan['original_upb']
-
-    for i in range(0, max_loan_age):
-
-        trans.append(
-            [
-                loan_id,
-                reporting_month, # reporting month
-                servicer, # servicer
-                "", #master_servicer
-                float(interest_rate) if interest_rate else None, # current_interest_rate
-                None if upb_skip > 0 or  i == max_loan_age -1 else max(0, round(current_actual_upb, 1)) , # current_upb
-                i if i < max_loan_age -1 else None, # loan_age
-                loan_term if i < max_loan_age -1 else None, # remaining_months_to_legal_maturity
-                loan_term - 1 if i < max_loan_age -1 else None, # remaining_months_to_maturity
-                maturity_date if i < max_loan_age -1 else None,
-                msa, # msa
-                "00" if i < max_loan_age -1 else "XX", # current_loan_delinquency_status
-                "", #loan_payment_history
-                "Y" if random.random() < 0.01 else "N", # modification_flag
-                "", #mortgage_insurance_cancellation_flag
-                "" if i < max_loan_age -1 else zero_balance_code, #zero_balance_code
-                None if i < max_loan_age -1 else reporting_month, #zero_balance_effective_date
-                None, #'last_paid_installment_date',
-                None, #'foreclosure_date',
-                None, # 'disposition_date',
-                None, # 'foreclosure_costs',
-                None, #'credit_enhancement_proceeds',
-                None, #'repurchase_make_whole_proceeds',
-                None, # 'other_foreclosure_proceeds',
-                None, # modification_noninterest_bearing_upb',
-                None, #'principal_foregiveness_amount',
-                None if i < max_loan_age -1 else "Y", #'repurchase_make_whole_proceeds_flag',
-                None, #'borrower_credit_score_current',
-                None, #'coborrower_credit_score_current',
-                None, #'foreclosure_principal_writeoff_amount',
-                None, #'next_interest_rate_adjustment_date',
-                None, #'next_payment_change_date'
-            ]
-        )
-        reporting_month += relativedelta(months=1)
-        loan_term -= 1
-        upb_skip -= 1
-        if upb_skip <= 0:
-            current_actual_upb -= monthly_upb
-
-        if i > loan_term or current_actual_upb <=0:
-            break
-
-
-        
-    return trans
-
-
-def generate_perf_data_for_non_performing_not_sale_loan(loan, perf_conf, zero_balance_code="02"):
+    n = loans.num_rows
+    credit_score = loans.column('borrower_credit_score_at_origination').fill_null(0).to_numpy()
+    credit_score_bin = np.where(credit_score < 500, 0, (credit_score - 500) // 20 + 1)
+
+    zero_balance_code = np.empty(n, dtype=object)
+    for credit_bin, rows in group_indices(credit_score_bin):
+        zero_balance_code_weight = perf_conf['zero_balance_code_distribution'].get(str(int(credit_bin)), DEFAULT_ZERO_BALANCE_CODE)
+        zero_balance_code[rows] = zero_balance_code_weight.choices(len(rows), rng)
+
+    # The loan payment will go to the LAST_LOAN_REPORTING_MONTH
+    current_loan_age = LAST_LOAN_REPORTING_MONTH - date32_to_month_index(loans.column('origination_date'))
+
+    kind = np.empty(n, dtype=np.int8)
+    max_loan_age = np.empty(n, dtype=np.int64)
+    delinquent_num = np.zeros(n, dtype=np.int64)
+    for code, rows in group_indices(zero_balance_code):
+        kind[rows] = LOAN_KINDS.get(code, NON_PERFORMING)
+        if kind[rows[0]] == CURRENT:
+            max_loan_age[rows] = current_loan_age[rows]
+        else:
+            max_loan_age[rows] = perf_conf["loan_age_distribution"][code].choices(len(rows), rng)
+        if kind[rows[0]] in (CURRENT, THIRD_PARTY_SALE):
+            delinquent_num[rows] = perf_conf["delinquency_distribution"][code].choices(len(rows), rng)
+    max_loan_age = np.maximum(max_loan_age, 1)
+
+    msa = np.empty(n, dtype=object)
+    zips = loans.column('zip').fill_null('None').to_numpy(zero_copy_only=False)
+    for state, state_rows in group_by_value(loans.column('property_state')):
+        for zip_code, rows in group_indices(zips[state_rows]):
+            msa_weight = perf_conf['msa'][state].get(zip_code, DEFAULT_MSA)
+            msa[state_rows[rows]] = msa_weight.choices(len(rows), rng)
+
+    servicer = np.empty(n, dtype=object)
+    for seller_name, rows in group_by_value(loans.column('seller_name')):
+        servicer[rows] = perf_conf['servicer'][seller_name].choices(len(rows), rng)
+
+    return {
+        'zero_balance_code': zero_balance_code,
+        'kind': kind,
+        'max_loan_age': max_loan_age,
+        'delinquent_num': delinquent_num,
+        'msa': msa,
+        'servicer': servicer,
+        'upb_skip': rng.integers(1, 4, n),
+    }
+
+
+def generate_perf_rows(loans, outcomes, perf_conf, rng):
     '''
-    For a non_performing_not_sale_loan:
-     1) sample a number of loan age: 
-        - last delingquent number is XX
-        - the last upb is set to 0
-        - zero_balance_code is 16
-        - zero_balance_effective_date is last reporting month
-        - repurchase_make_whole_proceeds_flag is "N"
-     4) TODO: it may default in the middle
+    Build the performance rows of a batch of loans with their sampled outcomes
+    as one encoded_perf_schema RecordBatch. Every column is computed for all rows of the
+    batch at once instead of walking each loan month by month:
+
+     1) every loan gets monthly rows starting the month after origination, up to
+        max_loan_age. Like the old month by month loop, the rows stop early once
+        i > remaining loan term or the upb is paid off.
+     2) current_upb is reported after upb_skip months, it goes down by
+        original_upb / original_loan_term every month except delinquent months.
+     3) current and 3rd party sale loans are delinquent in their last
+        delinquent_num months, the delinquency status counts up from 01.
+     4) prepaid (01) and 3rd party sale (02, 03, 09, 15) loans end with an extra
+        row with a 0 upb and the zero_balance_code.
+     5) for repurchased (06) and non performing (16, others) loans, the last of
+        max_loan_age rows carries the zero_balance_code.
     '''
-
-    trans = []
-    loan_id = loan['loan_id']
-    interest_rate = loan['original_interest_rate']
-    orig_date = loan['origination_date']
-    seller_name = loan['seller_name']
-    loan_term = loan['original_loan_term']
-    reporting_month = orig_date + relativedelta(months=1)
-    maturity_date = orig_date + relativedelta(months=loan_term)
-
-
-    weights = perf_conf["loan_age_distribution"][zero_balance_code]
-    max_loan_age = max(int(float(get_random_choice(weights))), 1)
-
-    msa_weight = perf_conf['msa'][loan['property_state']].get(str(loan['zip']), {'00000': 1})
-    servicer_weight = perf_conf['servicer'][seller_name]
-
-    msa = get_random_choice(msa_weight)
-    servicer = get_random_choice(servicer_weight)
-
-    # upb
-    upb_skip = random.choices([1,2,3])[0]
-    monthly_upb = loan['original_upb']/loan_term
-    current_actual_upb = loan['original_upb']
-
-    for i in range(0, max_loan_age):
-
-        trans.append(
-            [
-                loan_id,
-                reporting_month, # reporting month
-                servicer, # servicer
-                "", #master_servicer
-                float(interest_rate) if interest_rate else None, # current_interest_rate
-                None if upb_skip > 0 or  i == max_loan_age -1 else max(0, round(current_actual_upb, 1)) , # current_upb
-                i if i < max_loan_age -1 else None, # loan_age
-                loan_term if i < max_loan_age -1 else None, # remaining_months_to_legal_maturity
-                loan_term - 1 if i < max_loan_age -1 else None, # remaining_months_to_maturity
-                maturity_date if i < max_loan_age -1 else None,
-                msa, # msa
-                "00" if i < max_loan_age -1 else "XX", # current_loan_delinquency_status
-                "", #loan_payment_history
-                "Y" if random.random() < 0.01 else "N", # modification_flag
-                "", #mortgage_insurance_cancellation_flag
-                "" if i < max_loan_age -1 else zero_balance_code, #zero_balance_code
-                None if i < max_loan_age -1 else reporting_month, #zero_balance_effective_date
-                None, #'last_paid_installment_date',
-                None, #'foreclosure_date',
-                None, # 'disposition_date',
-                None, # 'foreclosure_costs',
-                None, #'credit_enhancement_proceeds',
-                None, #'repurchase_make_whole_proceeds',
-                None, # 'other_foreclosure_proceeds',
-                None, # modification_noninterest_bearing_upb',
-                None, #'principal_foregiveness_amount',
-                None if i < max_loan_age -1 else "N", #'repurchase_make_whole_proceeds_flag',
-                None, #'borrower_credit_score_current',
-                None, #'coborrower_credit_score_current',
-                None, #'foreclosure_principal_writeoff_amount',
-                None, #'next_interest_rate_adjustment_date',
-                None, #'next_payment_change_date'
-            ]
-        )
-        reporting_month += relativedelta(months=1)
-        loan_term -= 1
-        upb_skip -= 1
-        if upb_skip <= 0:
-            current_actual_upb -= monthly_upb
-        
-        if i > loan_term or current_actual_upb <=0:
-            break
-   
-    return trans
-
-def generate_perf(loan, perf_conf):
+    n = loans.num_rows
+    kind = outcomes['kind']
+    max_loan_age = outcomes['max_loan_age']
+    upb_skip = outcomes['upb_skip']
+    third_party = kind == THIRD_PARTY_SALE
+    has_terminal = (kind == PREPAID) | third_party
+    has_final = (kind == REPURCHASED) | (kind == NON_PERFORMING)
+    delinquent = (kind == CURRENT) | third_party
+
+    orig_month = date32_to_month_index(loans.column('origination_date'))
+    loan_term = loans.column('original_loan_term').fill_null(0).to_numpy().astype(np.int64)
+    original_upb = loans.column('original_upb').to_numpy(zero_copy_only=False).astype(np.float64)
+    monthly_upb = np.divide(original_upb, loan_term, out=np.zeros(n), where=loan_term > 0)
+    interest_rate = loans.column('original_interest_rate').to_numpy(zero_copy_only=False).astype(np.float64)
+
+    # first delinquent month: i + delinquent_num + 2 > max_loan_age
+    delinquent_from = np.where(delinquent, np.maximum(max_loan_age - outcomes['delinquent_num'] - 1, 0), NEVER)
+
+    # months paid before row i, delinquent months are not paid
+    def months_paid(loan, i):
+        return np.maximum(i + 1 - upb_skip[loan], 0) - np.maximum(i - delinquent_from[loan], 0)
+
+    # monthly rows until the loop breaks after the first i with 2 * i + 1 > loan_term
+    row_cnt = np.where(has_terminal, max_loan_age - 1, max_loan_age)
+    row_cnt = np.minimum(row_cnt, np.maximum((loan_term + 1) // 2, 0) + 1)
+
+    # or after the first i that pays off the upb
+    loan, i = loan_rows(row_cnt)
+    paid_off = original_upb[loan] - monthly_upb[loan] * months_paid(loan, i + 1) <= 0
+    first_paid_off = np.full(n, NEVER)
+    np.minimum.at(first_paid_off, loan[paid_off], i[paid_off])
+    row_cnt = np.minimum(row_cnt, first_paid_off + 1)
+
+    loan, i = loan_rows(row_cnt + has_terminal)
+    rows = len(loan)
+    terminal = has_terminal[loan] & (i == row_cnt[loan])
+    final = has_final[loan] & (i == max_loan_age[loan] - 1)
+    last = terminal | final
+    monthly = ~last
+    third_party_terminal = terminal & third_party[loan]
+
+    reporting_month = orig_month[loan] + 1 + i
+    delinquent_months = np.minimum(np.maximum(i - delinquent_from[loan], 0), 99)
+
+    current_upb = original_upb[loan] - monthly_upb[loan] * months_paid(loan, i)
+    current_upb = np.where(terminal, 0.0, np.fmax(np.round(current_upb, 1), 0))
+
+    # status codes index into status_values, 3rd party sales that keep their
+    # number of delinquent months at the end get its code, numbers outside of
+    # 00-99 are appended. The values stay distinct, Parquet does not write
+    # string dictionaries with duplicates reproducibly
+    status = np.where(final, STATUS_XX, delinquent_months)
+    last_status = np.full(rows, STATUS_XX)
+    last_status[terminal & ~third_party[loan] & (rng.random(rows) < 0.05)] = 0
+    keep_delinquent = np.isin(outcomes['zero_balance_code'], ["02", "09", "15"])[loan] & third_party_terminal
+    keep_delinquent &= rng.random(rows) < 0.05
+    kept = outcomes['delinquent_num'][loan[keep_delinquent]]
+    other = (kept < 0) | (kept >= STATUS_XX)
+    other_values, other_status = np.unique(kept[other], return_inverse=True)
+    status_values = STATUS_VALUES + [f"{d:02d}" for d in other_values]
+    last_status[keep_delinquent] = np.where(other, 0, kept)
+    last_status[np.flatnonzero(keep_delinquent)[other]] = len(STATUS_VALUES) + other_status
+    status = np.where(terminal, last_status, status)
+
+    # the status of the 24 months before each row, oldest first. Rows before the
+    # first delinquent month all share one "00" value, only the delinquent tail of
+    # current and 3rd party sale loans is encoded row by row, and then made distinct
+    history = np.full(rows, -1)
+    history[monthly & ((kind[loan] == PREPAID) | delinquent[loan])] = HISTORY_ALL_CURRENT
+    history[has_final[loan]] = HISTORY_EMPTY
+    rolling = delinquent[loan] & monthly & (i > delinquent_from[loan])
+    rolling_history = encode_payment_history(i[rolling], delinquent_from[loan[rolling]]).dictionary_encode()
+    history[rolling] = len(HISTORY_VALUES) + rolling_history.indices.to_numpy()
+    history_values = pa.concat_arrays([HISTORY_VALUES, rolling_history.dictionary])
+
+    # "" on monthly rows, the loan's code on its last row. Current loans have
+    # the code "" too, it is added once so the values stay distinct
+    zero_balance_codes, zero_balance_code = np.unique(np.append(outcomes['zero_balance_code'], ""),
+                                                      return_inverse=True)
+    zero_balance_code = np.where(last, zero_balance_code[loan], zero_balance_code[-1])
+
+    repurchase_flag = (final & (kind[loan] == REPURCHASED)).astype(np.int8)
+
+    # 3rd party sales record the first delinquent month as the last paid installment
+    last_paid_month = orig_month + 1 + np.minimum(delinquent_from, max_loan_age)
+    last_paid_nulls = ~third_party_terminal | (delinquent_from[loan] >= row_cnt[loan])
+
+    # values that are constant for a loan are kept once per loan as the dictionary
+    rate = interest_rate[loan]
+    columns = {
+        'loan_id': dictionary_array(loans.column('loan_id'), loan),
+        'monthly_reporting_period': month_index_to_date32(reporting_month),
+        'servicer_name': per_loan_dictionary(outcomes['servicer'], loan, terminal),
+        'master_servicer': run_end_constant("", rows, pa.string()),
+        'current_interest_rate': dictionary_array(
+            pa.array(interest_rate), loan, np.isnan(rate) | (terminal & ~third_party[loan]) | (~terminal & (rate == 0))),
+        'current_upb': pa.array(current_upb, mask=final | (monthly & (i < upb_skip[loan]))),
+        'loan_age': pa.array(i, mask=last),
+        'remaining_months_to_legal_maturity': pa.array(loan_term[loan] - i, mask=last),
+        'remaining_months_to_maturity': pa.array(loan_term[loan] - i - 1, mask=last),
+        'maturity_date': dictionary_array(month_index_to_date32(orig_month + loan_term), loan, last),
+        'msa': per_loan_dictionary(outcomes['msa'], loan),
+        'current_loan_delinquency_status': dictionary_array(status_values, status),
+        'loan_payment_history': dictionary_array(history_values, history, history < 0),
+        'modification_flag': dictionary_array(FLAG_VALUES, (rng.random(rows) < 0.01).astype(np.int8), terminal),
+        'mortgage_insurance_cancellation_flag': run_end_constant("", rows, pa.string()),
+        'zero_balance_code': dictionary_array(zero_balance_codes, zero_balance_code),
+        'zero_balance_effective_date': month_index_to_date32(reporting_month, monthly),
+        'last_paid_installment_date': month_index_to_date32(last_paid_month[loan], last_paid_nulls),
+        'foreclosure_date': month_index_to_date32(reporting_month, ~third_party_terminal),
+        'disposition_date': month_index_to_date32(reporting_month, ~third_party_terminal),
+        'repurchase_make_whole_proceeds_flag': dictionary_array(FLAG_VALUES, repurchase_flag, monthly),
+    }
+    for col in terminal_normal_cols:
+        values = np.full(rows, np.nan)
+        values[third_party_terminal] = generate_col_from_normal_distribution_perf(col, perf_conf, int(third_party_terminal.sum()), rng)
+        columns[col] = pa.array(values, mask=np.isnan(values))
+
+    schema = with_loan_id_type(encoded_perf_schema, loans.schema.field('loan_id').type)
+    arrays = [
+        conform(columns[field.name], field.type) if field.name in columns else pa.nulls(rows, type=field.type)
+        for field in schema
+    ]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def combine_acq_perf(loans, perf):
+    '''
+    The perf rows of a batch of loans with the acq columns of their loan appended
+    (combined_schema). The acq columns are dictionaries over the loans' values,
+    indexed by the loan of every row, so acq values are not copied per perf row.
+    '''
+    loan = perf.column('loan_id').indices.to_numpy()
+    arrays = perf.columns
+    for field, column in zip(loans.schema, loans.columns):
+        if field.name == 'loan_id':
+            continue
+        valid = column.is_valid().to_numpy(zero_copy_only=False)
+        if pa.types.is_dictionary(field.type):
+            arrays.append(dictionary_array(column.dictionary, column.indices.fill_null(0).to_numpy()[loan], ~valid[loan]))
+        else:
+            # one entry per distinct value: writers do not support nulls in the dictionary,
+            # the null loans are masked instead, and Parquet does not write string
+            # dictionaries with duplicates reproducibly
+            distinct = column.dictionary_encode()
+            arrays.append(dictionary_array(distinct.dictionary, distinct.indices.fill_null(0).to_numpy()[loan], ~valid[loan]))
+    return pa.RecordBatch.from_arrays(arrays, schema=combined_schema(perf.schema, loans.schema))
+
+
+def generate_perf(loans, perf_conf, rng=None):
         '''
-        Give a loan with information from the loan acquisition data:
-            - loan_id: uuid
+        Give a batch of loans with information from the loan acquisition data:
+            - loan_id: uuid or partition prefixed counter (see generate_loan_ids)
             - interest rate at loan origination
             - loan term at loan orig
             - seller name
@@ -607,30 +373,10 @@ def generate_perf(loan, perf_conf):
             - reporting month
             - upb
 
-         - 
+        Returns the perf rows of all loans in the batch as one encoded_perf_schema RecordBatch,
+        drawn from the np.random.Generator rng (a fresh one by default).
         '''
 
-        # The most important feature of a loan: zero_balance_code
-        credit_score = loan["borrower_credit_score_at_origination"]
-        credit_score_bin = 0
-        if credit_score:
-            if credit_score < 500:
-                credit_score_bin = 0
-            else:
-                credit_score_bin = (credit_score - 500) // 20 + 1
-        zero_balance_code_weight = perf_conf['zero_balance_code_distribution'].get(str(int(float(credit_score_bin))), {"01": 1})
-        zero_balance_code = get_random_choice(zero_balance_code_weight)
-
-        if zero_balance_code == "":
-            return generate_perf_data_for_current_loan(loan, perf_conf, zero_balance_code)
-        elif zero_balance_code == "01":
-            return generate_perf_data_for_prepaid_loan(loan, perf_conf, zero_balance_code)
-        elif zero_balance_code in ["02", "03", "09", "15"]:
-            return generate_perf_data_for_3rd_party_sale_loan(loan, perf_conf, zero_balance_code)
-        elif zero_balance_code in ["06"]:
-            return generate_perf_data_for_repurchased_loan(loan, perf_conf, zero_balance_code)
-        elif zero_balance_code in ["16"]:
-            return generate_perf_data_for_non_performing_not_sale_loan(loan, perf_conf, zero_balance_code)
-        else: # all others, al most no loan here
-            return generate_perf_data_for_non_performing_not_sale_loan(loan, perf_conf, zero_balance_code)
-        
\ No newline at end of file
+        rng = np.random.default_rng(rng)
+        outcomes = sample_perf_outcomes(loans, perf_conf, rng)
+        return generate_perf_rows(loans, outcomes, perf_conf, rng)
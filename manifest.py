@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+
+
+# The manifest of a dataset sits at {dataset_path}/MANIFEST_NAME, it is ignored by
+# dataset readers like the files being written
+MANIFEST_NAME = '_manifest.json'
+TMP_PREFIX = '.'
+TMP_SUFFIX = '.tmp'
+
+PENDING = 'pending'
+COMPLETE = 'complete'
+
+
+def tmp_path(file_name):
+    '''
+    The name a file is written under until it is committed
+    '''
+    directory, base = os.path.split(file_name)
+    return os.path.join(directory, f'{TMP_PREFIX}{base}{TMP_SUFFIX}')
+
+
+def file_checksum(file_name, block_size=1 << 20):
+    '''
+    sha256 of a file, read in blocks
+    '''
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def write_json_atomic(data, file_name):
+    '''
+    Replace file_name by data, readers see either the old or the new file
+    '''
+    tmp_name = tmp_path(file_name)
+    with open(tmp_name, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_name, file_name)
+
+
+def file_shard(file_name):
+    '''
+    The shard name of a data file named {table}_{shard_name}_{num}{extension}
+    (see FileSink), committed or not, None for any other file
+    '''
+    if file_name.startswith(TMP_PREFIX) and file_name.endswith(TMP_SUFFIX):
+        file_name = file_name[len(TMP_PREFIX):-len(TMP_SUFFIX)]
+    _, _, stem = file_name.split('.')[0].partition('_')
+    shard_name, _, num = stem.rpartition('_')
+    return shard_name if shard_name and num.isdigit() else None
+
+
+def remove_shard_files(dataset_path, shard_names):
+    '''
+    Remove the files unfinished runs of shard_names left below dataset_path,
+    returns the number of files removed
+    '''
+    removed = 0
+    for directory, _, file_names in os.walk(dataset_path):
+        for file_name in file_names:
+            if file_shard(file_name) in shard_names:
+                os.remove(os.path.join(directory, file_name))
+                removed += 1
+    return removed
+
+
+class Manifest:
+    '''
+    The status of every shard of a dataset, written by the main process only.
+
+    A shard is PENDING until its worker has closed, checksummed and renamed all
+    its files (FileSink.commit), its entry then records the row counts of its
+    tables and the path, rows, bytes and sha256 of every file. Every change is
+    saved atomically, so after a crash the manifest lists exactly the shards
+    whose files are complete; the files of the other shards are partial.
+
+    params are the settings the data depends on, a run can only be resumed with
+    the same params.
+    '''
+
+    def __init__(self, dataset_path, params, shards=None):
+        self.dataset_path = dataset_path
+        self.params = params
+        self.shards = shards or {}
+
+    @property
+    def path(self):
+        return f'{self.dataset_path}/{MANIFEST_NAME}'
+
+    @classmethod
+    def load(cls, dataset_path):
+        with open(f'{dataset_path}/{MANIFEST_NAME}') as f:
+            data = json.load(f)
+        return cls(dataset_path, data['params'], data['shards'])
+
+    @classmethod
+    def exists(cls, dataset_path):
+        return os.path.exists(f'{dataset_path}/{MANIFEST_NAME}')
+
+    def save(self):
+        os.makedirs(self.dataset_path, exist_ok=True)
+        write_json_atomic({'params': self.params, 'shards': self.shards}, self.path)
+
+    def completed(self):
+        return {name for name, entry in self.shards.items() if entry['status'] == COMPLETE}
+
+    def add_pending(self, shards):
+        for shard in shards:
+            if shard.name not in self.shards or self.shards[shard.name]['status'] != COMPLETE:
+                self.shards[shard.name] = {'partition': shard.partition, 'status': PENDING, 'cost': shard.cost}
+        self.save()
+
+    def commit(self, shard_name, entry):
+        self.shards[shard_name] = dict(self.shards.get(shard_name, {}), **entry, status=COMPLETE)
+        self.save()
+
+
+def merge_manifests(dataset_path, node_prefixes):
+    '''
+    Merge the Manifests the nodes of a multi-node run wrote below their
+    node_prefixes of dataset_path into the Manifest of the whole dataset, with
+    file paths relative to dataset_path. Raises ValueError unless every node
+    completed all its shards with the same params.
+    '''
+    params = None
+    shards = {}
+    for node, prefix in enumerate(node_prefixes):
+        if not Manifest.exists(f'{dataset_path}/{prefix}'):
+            raise ValueError(f'no manifest for node {node} at {dataset_path}/{prefix}')
+        manifest = Manifest.load(f'{dataset_path}/{prefix}')
+        node_params = {key: val for key, val in manifest.params.items() if key != 'shard_index'}
+        if params is None:
+            params = node_params
+        elif node_params != params:
+            raise ValueError(f'node {node} ran with other settings: {manifest.params}')
+        pending = set(manifest.shards) - manifest.completed()
+        if pending:
+            raise ValueError(f'node {node} has {len(pending)} shards to complete, e.g. {min(pending)}')
+        for name, entry in manifest.shards.items():
+            if name in shards:
+                raise ValueError(f'shard {name} was generated by nodes {shards[name]["node"]} and {node}')
+            # the shared perf dataset of perf_partition_by is outside the prefix (../perf/...)
+            files = [dict(file, path=os.path.normpath(f'{prefix}/{file["path"]}')) for file in entry['files']]
+            shards[name] = dict(entry, files=files, node=node)
+    manifest = Manifest(dataset_path, params, shards)
+    manifest.save()
+    return manifest
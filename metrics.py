@@ -0,0 +1,168 @@
+import multiprocessing
+import resource
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+# Phases timed by the workers:
+#   loan_sampling     generate_loans
+#   perf_generation   generate_perf and combine_acq_perf
+#   arrow_conversion  assembling the flushed tables and decoding them for the sink
+#   write             encoding, compressing and writing files, or handing tables to a stream
+#   commit            checksumming and renaming the files of a shard
+PHASES = ['loan_sampling', 'perf_generation', 'arrow_conversion', 'write', 'commit']
+
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of this process (ru_maxrss is in KB on Linux)
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Metrics:
+    '''
+    Phase timers and counters of one process. Phases timed on different threads
+    (e.g. BackgroundWriter) overlap, so their seconds can add up to more than the
+    wall time. take() returns what was recorded since its last call.
+    '''
+
+    def __init__(self):
+        self.seconds = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_seconds(phase, time.perf_counter() - start)
+
+    def add_seconds(self, phase, seconds):
+        with self._lock:
+            self.seconds[phase] = self.seconds.get(phase, 0) + seconds
+
+    def count(self, name, n):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def take(self):
+        with self._lock:
+            taken = {'seconds': self.seconds, 'counters': self.counters}
+            self.seconds = {}
+            self.counters = {}
+        return taken
+
+
+# The Metrics of this process: the sinks and generate_data record into it
+process_metrics = Metrics()
+
+
+def add_to(totals, values):
+    for key, val in values.items():
+        totals[key] = totals.get(key, 0) + val
+
+
+class RunReport:
+    '''
+    Aggregates the metrics the pool workers put on its queue (see
+    generate_data.report_metrics) on a thread of the main process, into the
+    totals, per worker and per shard figures of to_dict(). With log_interval
+    the totals so far are printed every log_interval seconds.
+
+    A message is (pid, peak RSS MB, process_metrics.take(), shard) where shard is
+    None for an update during a shard and {name, seconds} once it is complete.
+    Close it after the pool is joined, so every message of the workers is in.
+    '''
+
+    def __init__(self, log_interval=None):
+        self.log_interval = log_interval
+        self.queue = multiprocessing.Queue()
+        self.start = time.perf_counter()
+        self.seconds = {}
+        self.counters = {}
+        self.workers = {}
+        self.shards = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = [threading.Thread(target=self._collect, daemon=True)]
+        if log_interval:
+            self._threads.append(threading.Thread(target=self._log, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _collect(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            self.add(*message)
+
+    def _log(self):
+        while not self._stopped.wait(self.log_interval):
+            print(self.summary())
+
+    def add(self, pid, rss_mb, taken, shard=None):
+        with self._lock:
+            add_to(self.seconds, taken['seconds'])
+            add_to(self.counters, taken['counters'])
+            worker = self.workers.setdefault(str(pid), {'shards': 0, 'seconds': 0, 'peak_rss_mb': 0,
+                                                        'phase_seconds': {}, 'counters': {}})
+            add_to(worker['phase_seconds'], taken['seconds'])
+            add_to(worker['counters'], taken['counters'])
+            worker['peak_rss_mb'] = max(worker['peak_rss_mb'], rss_mb)
+            if shard is not None:
+                worker['shards'] += 1
+                worker['seconds'] += shard['seconds']
+                self.shards[shard['name']] = dict(shard, worker=str(pid))
+
+    def rows(self, counters):
+        return sum(val for name, val in counters.items() if name.endswith('_rows'))
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.perf_counter() - self.start
+            rows = self.rows(self.counters)
+            written_mb = self.counters.get('written_bytes', 0) / (1024 * 1024)
+            files = self.counters.get('written_files', 0)
+            rss_mb = max([worker['peak_rss_mb'] for worker in self.workers.values()], default=0)
+            phases = ', '.join(f"{phase} {self.seconds[phase]:.1f}s" for phase in PHASES if phase in self.seconds)
+            return (f"{elapsed:.0f}s: {len(self.shards)} shards, {rows} rows ({rows / elapsed:.0f}/s), "
+                    f"{written_mb:.1f} MB written in {files} files, worker peak RSS {rss_mb:.0f} MB; {phases}")
+
+    def close(self, timeout=None):
+        self.queue.put(None)
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # after an error the workers may have been terminated mid-put
+        self.close(None if exc_type is None else 1)
+
+    def to_dict(self):
+        wall_seconds = time.perf_counter() - self.start
+        rows = self.rows(self.counters)
+        workers = {}
+        for pid, worker in self.workers.items():
+            worker_rows = self.rows(worker['counters'])
+            workers[pid] = dict(worker, rows=worker_rows,
+                                rows_per_second=worker_rows / worker['seconds'] if worker['seconds'] else None)
+        return {
+            'wall_seconds': wall_seconds,
+            'rows': rows,
+            'rows_per_second': rows / wall_seconds,
+            'counters': self.counters,
+            'phase_seconds': self.seconds,
+            'peak_rss_mb': max([worker['peak_rss_mb'] for worker in self.workers.values()], default=0),
+            'main_peak_rss_mb': peak_rss_mb(),
+            'workers': workers,
+            'shards': self.shards,
+        }
@@ -0,0 +1,524 @@
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import sys
+import threading
+
+from urllib.parse import quote
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as csv
+import pyarrow.dataset as ds
+import pyarrow.orc as orc
+import pyarrow.parquet as pq
+
+from manifest import tmp_path, file_checksum
+from metrics import process_metrics
+from utils import acq_headers, perf_headers, decode_columns, decode_run_end, decoded_schema, group_indices
+
+
+# Files of a sink roll over to the next one once they reach this size
+DEFAULT_TARGET_FILE_MB = 256
+
+# Hive partition keys that are computed from a column instead of being one
+DERIVED_PARTITION_KEYS = {
+    'reporting_year': lambda table: pc.year(table.column('monthly_reporting_period')),
+}
+# Directory value of null keys. Empty strings (e.g. the zero_balance_code of
+# active loans) are missing values in the Fannie Mae layout and Hive rejects
+# empty partition values, so they get it too and are read back as null
+HIVE_NULL_VALUE = '__HIVE_DEFAULT_PARTITION__'
+# _common_metadata schema metadata listing the Hive keys of a dataset, see hive_partitioning
+PARTITION_BY_METADATA = b'partition_by'
+
+# The Fannie Mae layout of the csv sink
+CSV_HEADERS = {
+    'acq': acq_headers,
+    'perf': perf_headers,
+    'combined': perf_headers + acq_headers[1:],
+}
+CSV_DAY_DATE_COLS = ['monthly_reporting_period', 'last_paid_installment_date', 'foreclosure_date', 'disposition_date']
+CSV_BATCH_ROWS = 64 * 1024
+
+# Named pq.ParquetWriter settings of the parquet sink, besides the writer options:
+#   row_group_size        max rows per row group, larger flushes are split
+#   byte_stream_split     BYTE_STREAM_SPLIT instead of dictionary encoding for plain float columns
+#   bloom_filter_columns  columns with a bloom filter in every row group
+PARQUET_PROFILES = {
+    # the settings used before profiles existed
+    'default': {
+        'compression': 'ZSTD',
+    },
+    # cheapest to write, for generation throughput
+    'fast': {
+        'compression': 'LZ4',
+        'write_statistics': False,
+    },
+    # smallest files
+    'small': {
+        'compression': 'ZSTD',
+        'compression_level': 9,
+        'byte_stream_split': True,
+        'data_page_size': 1024 * 1024,
+    },
+    # selective reads: page indexes, smaller pages and row groups, loan_id lookups
+    'query-optimized': {
+        'compression': 'ZSTD',
+        'write_page_index': True,
+        'data_page_size': 128 * 1024,
+        'row_group_size': 256 * 1024,
+        'bloom_filter_columns': ['loan_id'],
+    },
+}
+BLOOM_FILTER_OPTIONS = {'ndv': 128 * 1024, 'fpp': 0.01}
+
+# Tables waiting to be written to an IPC stream, workers block on the next one
+STREAM_QUEUE_TABLES = 2
+
+
+class FileSink:
+    '''
+    Base of the output sinks: streams the tables of one partition into
+    {output_path}/{name}/{name}_{partition}_{num}{extension} through a single open
+    writer. The file is closed and the next one started once it reaches
+    target_file_mb. No file is created for a sink nothing is written to.
+    directory replaces {output_path}/{name} as the directory of the files.
+
+    Files are written under their tmp_path and only get their name in commit(),
+    so a crashed run never leaves a complete looking file behind.
+
+    Subclasses open the format's writer in _open_writer and may convert the
+    tables in _prepare, by default encoded columns are decoded (decode_columns).
+    '''
+    extension = None
+
+    def __init__(self, output_path, partition, name, target_file_mb=DEFAULT_TARGET_FILE_MB, directory=None):
+        self.output_path = output_path
+        self.partition = partition
+        self.name = name
+        self.directory = directory or f'{output_path}/{name}'
+        self.target_file_bytes = target_file_mb * 1024 * 1024
+        self.file_num = 0
+        self.file_names = []
+        self.file_rows = []
+        self._file = None
+        self._writer = None
+
+    def _open_writer(self, file, schema):
+        raise NotImplementedError
+
+    def _prepare(self, table):
+        return decode_columns(table)
+
+    def _write(self, table):
+        self._writer.write_table(table)
+
+    def _open(self, schema):
+        os.makedirs(self.directory, exist_ok=True)
+        file_name = f'{self.directory}/{self.name}_{self.partition}_{self.file_num}{self.extension}'
+        self._file = pa.OSFile(tmp_path(file_name), 'wb')
+        self._writer = self._open_writer(self._file, schema)
+        self.file_names.append(file_name)
+        self.file_rows.append(0)
+
+    def _close_file(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._file.close()
+            self._writer = None
+            self._file = None
+            self.file_num += 1
+
+    def write(self, table):
+        with process_metrics.timer('arrow_conversion'):
+            table = self._prepare(table)
+        with process_metrics.timer('write'):
+            if self._writer is None:
+                self._open(table.schema)
+            self._write(table)
+            self.file_rows[-1] += table.num_rows
+            if self._file.tell() >= self.target_file_bytes:
+                self._close_file()
+
+    def close(self):
+        self._close_file()
+
+    def commit(self):
+        '''
+        Close the sink and rename its files to their names, returns a
+        {path, rows, bytes, sha256} record per file
+        '''
+        self.close()
+        files = []
+        for file_name, rows in zip(self.file_names, self.file_rows):
+            written_name = tmp_path(file_name)
+            files.append({
+                'path': file_name,
+                'rows': rows,
+                'bytes': os.path.getsize(written_name),
+                'sha256': file_checksum(written_name),
+            })
+            os.replace(written_name, file_name)
+        return files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parquet_writer_options(profile, schema):
+    '''
+    pq.ParquetWriter keyword arguments of a PARQUET_PROFILES profile for schema
+    '''
+    options = dict(PARQUET_PROFILES[profile])
+    options.pop('row_group_size', None)
+    if options.pop('byte_stream_split', False):
+        floats = [field.name for field in schema if pa.types.is_floating(field.type)]
+        options['use_byte_stream_split'] = floats
+        options['use_dictionary'] = [name for name in schema.names if name not in floats]
+    bloom_filter_columns = [name for name in options.pop('bloom_filter_columns', []) if name in schema.names]
+    if bloom_filter_columns:
+        options['bloom_filter_options'] = {name: BLOOM_FILTER_OPTIONS for name in bloom_filter_columns}
+    return options
+
+
+class ParquetSink(FileSink):
+    '''
+    Parquet files written with a PARQUET_PROFILES profile, every written table
+    becomes a row group (split by the profile's row_group_size)
+    '''
+    extension = '.parquet'
+
+    def __init__(self, output_path, partition, name, target_file_mb=DEFAULT_TARGET_FILE_MB, directory=None,
+                 profile='default'):
+        super().__init__(output_path, partition, name, target_file_mb, directory)
+        self.profile = profile
+
+    def _open_writer(self, file, schema):
+        return pq.ParquetWriter(file, schema, **parquet_writer_options(self.profile, schema))
+
+    def _write(self, table):
+        self._writer.write_table(table, row_group_size=PARQUET_PROFILES[self.profile].get('row_group_size'))
+
+    def _prepare(self, table):
+        # Parquet keeps the dictionary columns but has no run-end encoding
+        return decode_run_end(table)
+
+
+class ArrowIpcSink(FileSink):
+    '''
+    Arrow IPC files (Feather v2), uncompressed by default so they can be memory
+    mapped and loaded without any parsing
+    '''
+    extension = '.arrow'
+
+    def __init__(self, output_path, partition, name, target_file_mb=DEFAULT_TARGET_FILE_MB, directory=None,
+                 compression=None):
+        super().__init__(output_path, partition, name, target_file_mb, directory)
+        self.compression = compression
+
+    def _open_writer(self, file, schema):
+        return pa.ipc.new_file(file, schema, options=pa.ipc.IpcWriteOptions(compression=self.compression))
+
+
+class OrcSink(FileSink):
+    '''
+    ORC files, every written table is added to the current stripe
+    '''
+    extension = '.orc'
+
+    def __init__(self, output_path, partition, name, target_file_mb=DEFAULT_TARGET_FILE_MB, directory=None,
+                 compression='zstd'):
+        super().__init__(output_path, partition, name, target_file_mb, directory)
+        self.compression = compression
+
+    def _open_writer(self, file, schema):
+        return orc.ORCWriter(file, compression=self.compression)
+
+    def _write(self, table):
+        self._writer.write(table)
+
+
+class CsvSink(FileSink):
+    '''
+    Pipe delimited files without header in the Fannie Mae acq / perf layout:
+    columns in acq_headers / perf_headers order, dates as MM/YYYY or MM/DD/YYYY.
+    Written by the pyarrow.csv writer in blocks of CSV_BATCH_ROWS rows.
+    '''
+    extension = '.csv'
+
+    def _open_writer(self, file, schema):
+        write_options = csv.WriteOptions(include_header=False, delimiter='|', batch_size=CSV_BATCH_ROWS,
+                                         quoting_style='none')
+        return csv.CSVWriter(file, schema, write_options=write_options)
+
+    def _prepare(self, table):
+        table = decode_columns(table)
+        table = table.select([col for col in CSV_HEADERS[self.name] if col in table.column_names])
+        for i, field in enumerate(table.schema):
+            if pa.types.is_date32(field.type):
+                date_format = '%m/%d/%Y' if field.name in CSV_DAY_DATE_COLS else '%m/%Y'
+                table = table.set_column(i, field.with_type(pa.string()), pc.strftime(table.column(i), format=date_format))
+        return table
+
+
+SINKS = {
+    'parquet': ParquetSink,
+    'arrow': ArrowIpcSink,
+    'orc': OrcSink,
+    'csv': CsvSink,
+}
+
+
+class QueueSink:
+    '''
+    Hands the decoded tables of a pool worker to an IpcStream of the main process.
+    write() blocks while the stream's queue is full.
+    '''
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, table):
+        with process_metrics.timer('arrow_conversion'):
+            table = decode_columns(table)
+        with process_metrics.timer('write'):
+            self.queue.put(table)
+        process_metrics.count('streamed_bytes', table.nbytes)
+
+    def close(self):
+        pass
+
+    def commit(self):
+        return []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_stream_target(target):
+    '''
+    Binary file object of a stream target: "-" for stdout, "unix:<path>" for a
+    connection to a unix domain socket, otherwise a file or named pipe path
+    '''
+    if target == '-':
+        return os.fdopen(os.dup(sys.__stdout__.fileno()), 'wb')
+    if target.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(target[len('unix:'):])
+        # the file keeps the connection open until it is closed itself
+        file = sock.makefile('wb')
+        sock.close()
+        return file
+    return open(target, 'wb')
+
+
+class IpcStream:
+    '''
+    Writes the tables QueueSinks put on its queue as one Arrow IPC stream of
+    decoded schema to target (see open_stream_target), on a thread of the main
+    process. The tables of concurrent partitions are interleaved.
+
+    Writing blocks while the reader is behind, the queue then fills up and the
+    workers block in QueueSink.write, so a slow reader throttles generation
+    instead of the tables piling up in memory. After an error (e.g. the reader
+    went away) the queue is still drained so the workers do not block, the error
+    is available as error for the main process to stop the pool, and raised by
+    close().
+
+    The acq and perf streams of a run fill up together: a reader has to read both
+    concurrently, reading one to its end before starting on the other deadlocks
+    as soon as the other's queue is full.
+    '''
+
+    def __init__(self, target, schema, max_tables=STREAM_QUEUE_TABLES):
+        self.target = target
+        self.schema = schema
+        self.queue = multiprocessing.Queue(max_tables)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        file = writer = None
+        try:
+            file = open_stream_target(self.target)
+            writer = pa.ipc.new_stream(file, self.schema)
+        except BaseException as e:
+            self._error = e
+        while True:
+            table = self.queue.get()
+            if table is None:
+                break
+            try:
+                if self._error is None:
+                    writer.write_table(table)
+            except BaseException as e:
+                self._error = e
+        try:
+            if writer is not None and self._error is None:
+                writer.close()
+            if file is not None:
+                file.close()
+        except BaseException as e:
+            self._error = self._error or e
+
+    @property
+    def error(self):
+        return self._error
+
+    def close(self, timeout=None):
+        '''
+        Write the end of the stream once the queued tables are written. With a
+        timeout the thread is given up on after it (e.g. when workers were
+        terminated while putting a table, which can leave the queue unreadable)
+        '''
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        try:
+            self.close(None if exc_type is None else 1)
+        except BaseException:
+            if exc_type is None:
+                raise
+
+
+class HivePartitionedSink:
+    '''
+    Writes the tables of one partition as part of a Hive partitioned dataset
+    {output_path}/{name}/{key}={value}/.../{name}_{partition}_{num}{extension}, keyed
+    on the partition_by columns or DERIVED_PARTITION_KEYS. The key columns are not
+    stored in the files, null and empty keys go to HIVE_NULL_VALUE. Every directory gets its own streaming sink_class sink,
+    created with the sink_options.
+    '''
+
+    def __init__(self, output_path, partition, name, partition_by, target_file_mb=DEFAULT_TARGET_FILE_MB,
+                 sink_class=ParquetSink, **sink_options):
+        self.output_path = output_path
+        self.partition = partition
+        self.name = name
+        self.partition_by = partition_by
+        self.target_file_mb = target_file_mb
+        self.sink_class = sink_class
+        self.sink_options = sink_options
+        self._sinks = {}
+
+    def _key_column(self, table, key):
+        if key in DERIVED_PARTITION_KEYS:
+            return DERIVED_PARTITION_KEYS[key](table)
+        return table.column(key)
+
+    def write(self, table):
+        with process_metrics.timer('arrow_conversion'):
+            table = decode_run_end(table)
+            codes = np.zeros(table.num_rows, dtype=np.int64)
+            key_values = []
+            for key in self.partition_by:
+                column = pa.chunked_array(self._key_column(table, key)).combine_chunks()
+                if pa.types.is_dictionary(column.type):
+                    column = column.dictionary_decode()
+                encoded = column.dictionary_encode()
+                values = encoded.dictionary.to_pylist() + [None]
+                indices = encoded.indices.fill_null(len(values) - 1).to_numpy()
+                codes = codes * len(values) + indices
+                key_values.append((values, indices))
+
+            table = table.drop_columns([key for key in self.partition_by if key in table.column_names])
+            groups = list(group_indices(codes))
+        for _, rows in groups:
+            row = rows[0]
+            directory = '/'.join(
+                f'{key}={HIVE_NULL_VALUE if values[indices[row]] in (None, "") else quote(str(values[indices[row]]), safe="")}'
+                for key, (values, indices) in zip(self.partition_by, key_values)
+            )
+            if directory not in self._sinks:
+                self._sinks[directory] = self.sink_class(
+                    self.output_path, self.partition, self.name, self.target_file_mb,
+                    directory=f'{self.output_path}/{self.name}/{directory}', **self.sink_options)
+            with process_metrics.timer('arrow_conversion'):
+                part = table.take(rows)
+            self._sinks[directory].write(part)
+
+    def close(self):
+        for sink in self._sinks.values():
+            sink.close()
+
+    def commit(self):
+        return [file for sink in self._sinks.values() for file in sink.commit()]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def partition_schema(schema, partition_by):
+    '''
+    The schema of the partition_by keys of a HivePartitionedSink dataset of tables of schema
+    '''
+    schema = decoded_schema(schema)
+    fields = []
+    for key in partition_by:
+        if key in DERIVED_PARTITION_KEYS:
+            fields.append(pa.field(key, DERIVED_PARTITION_KEYS[key](schema.empty_table()).type))
+        else:
+            fields.append(schema.field(key))
+    return pa.schema(fields)
+
+
+def hive_partitioning(dataset_path):
+    '''
+    The partitioning of a Parquet dataset written by write_dataset_metadata, with
+    the key types of its _common_metadata. Inferred from the directory names
+    alone, string keys such as zero_balance_code=01 would be read as integers:
+    pq.read_table(dataset_path, partitioning=hive_partitioning(dataset_path))
+    '''
+    schema = pq.read_schema(f'{dataset_path}/_common_metadata')
+    keys = json.loads(schema.metadata[PARTITION_BY_METADATA])
+    return ds.partitioning(pa.schema([schema.field(key) for key in keys]), flavor='hive')
+
+
+def write_dataset_metadata(dataset_path, key_schema):
+    '''
+    Write the _common_metadata schema and the consolidated _metadata footer of all
+    files of a Hive partitioned Parquet dataset, so readers can plan without
+    opening every file. _common_metadata has the key_schema fields (see
+    partition_schema) after those of the files and lists them as the keys.
+    '''
+    metadata = None
+    dataset = ds.dataset(dataset_path, format='parquet', partitioning=ds.partitioning(key_schema, flavor='hive'))
+    for fragment in dataset.get_fragments():
+        fragment_metadata = fragment.metadata
+        fragment_metadata.set_file_path(os.path.relpath(fragment.path, dataset_path))
+        if metadata is None:
+            metadata = fragment_metadata
+            schema = fragment.physical_schema
+            for field in key_schema:
+                schema = schema.append(field)
+            metadata_items = dict(schema.metadata or {})
+            metadata_items[PARTITION_BY_METADATA] = json.dumps(key_schema.names)
+            schema = schema.with_metadata(metadata_items)
+            pq.write_metadata(schema, f'{dataset_path}/_common_metadata')
+        else:
+            metadata.append_row_groups(fragment_metadata)
+    if metadata is not None:
+        metadata.write_metadata_file(f'{dataset_path}/_metadata')
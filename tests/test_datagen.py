@@ -0,0 +1,100 @@
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from manifest import MANIFEST_NAME, COMPLETE, PENDING
+from sinks import hive_partitioning
+
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# a tiny run: one year at sf=0.002 in shards of 100 loans, about 20 shards
+RUN_ARGS = ['-start_year', '2000', '-end_year', '2000', '-sf', '0.002', '-sf_name', 'test',
+            '-shard_loans', '100', '-seed', '7']
+
+
+def datagen(output_path, *args):
+    return [sys.executable, 'datagen.py', *RUN_ARGS, '-o', str(output_path), *args]
+
+
+def run_datagen(output_path, *args):
+    subprocess.run(datagen(output_path, *args), cwd=REPO_PATH, check=True, stdout=subprocess.DEVNULL)
+
+
+def dataset_files(output_path):
+    '''
+    sha256 of every file of a run's dataset but its run report, by relative path
+    '''
+    files = {}
+    for directory, _, file_names in os.walk(output_path):
+        for file_name in file_names:
+            if file_name != '_run_report.json':
+                path = os.path.join(directory, file_name)
+                with open(path, 'rb') as f:
+                    files[os.path.relpath(path, output_path)] = hashlib.sha256(f.read()).hexdigest()
+    return files
+
+
+def manifest_statuses(output_path):
+    with open(f'{output_path}/sf=0.002_test/{MANIFEST_NAME}') as f:
+        return [entry['status'] for entry in json.load(f)['shards'].values()]
+
+
+@pytest.fixture(scope='module')
+def reference_run(tmp_path_factory):
+    output_path = tmp_path_factory.mktemp('pools1')
+    run_datagen(output_path, '-pools', '1')
+    return output_path
+
+
+def test_same_output_for_any_pools(reference_run, tmp_path):
+    run_datagen(tmp_path, '-pools', '4')
+    files = dataset_files(tmp_path)
+    assert any(path.endswith('.parquet') for path in files)
+    assert files == dataset_files(reference_run)
+
+
+def test_resume_after_kill(reference_run, tmp_path):
+    process = subprocess.Popen(datagen(tmp_path, '-pools', '1'), cwd=REPO_PATH, stdout=subprocess.DEVNULL)
+    # kill the run once its first shard is complete
+    while process.poll() is None:
+        if os.path.exists(f'{tmp_path}/sf=0.002_test/{MANIFEST_NAME}') and \
+                COMPLETE in manifest_statuses(tmp_path):
+            break
+        time.sleep(0.01)
+    process.kill()
+    process.wait()
+    assert PENDING in manifest_statuses(tmp_path)
+
+    run_datagen(tmp_path, '-pools', '2', '-resume')
+    assert set(manifest_statuses(tmp_path)) == {COMPLETE}
+    assert dataset_files(tmp_path) == dataset_files(reference_run)
+
+
+def test_existing_dataset_needs_resume(reference_run):
+    result = subprocess.run(datagen(reference_run), cwd=REPO_PATH, capture_output=True)
+    assert result.returncode != 0
+    assert b'-resume' in result.stderr
+
+
+def test_partition_key_types_round_trip(reference_run, tmp_path):
+    run_datagen(tmp_path, '-pools', '2', '-perf_partition_by', 'reporting_year', 'zero_balance_code')
+    perf_path = f'{tmp_path}/sf=0.002_test/perf'
+    table = pq.read_table(perf_path, partitioning=hive_partitioning(perf_path)).combine_chunks()
+    assert table.schema.field('zero_balance_code').type == pa.string()
+    assert table.schema.field('reporting_year').type == pa.int64()
+
+    perf_files = glob.glob(f'{reference_run}/sf=0.002_test/*/perf/*.parquet')
+    reference = pq.ParquetDataset(perf_files).read(columns=['zero_balance_code'])
+    codes = set(reference.column('zero_balance_code').to_pylist()) - {''}
+    assert '01' in codes
+    # empty codes are read back as null, the others keep their leading zeros
+    assert set(table.column('zero_balance_code').drop_null().to_pylist()) == codes
+    assert table.num_rows == reference.num_rows
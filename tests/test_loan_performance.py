@@ -0,0 +1,162 @@
+from datetime import date
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from loan_performance import generate_perf_rows, terminal_normal_cols, LOAN_KINDS, NON_PERFORMING
+from loan_performance import CURRENT, PREPAID, THIRD_PARTY_SALE, REPURCHASED
+
+
+PERF_CONF = {
+    'col_norm_distribution': {
+        f'{col}_{stat}': val
+        for col in terminal_normal_cols
+        for stat, val in [('mean', 100.0), ('std', 10.0), ('min', 0.0), ('max', 1000.0)]
+    },
+}
+
+# (zero_balance_code, max_loan_age, delinquent_num, upb_skip, original_loan_term, original_upb)
+# of one loan of every kind. The loop stops at about half the loan term, which the
+# last three reach: without the row with the code of a repurchase
+OUTCOMES = [
+    ("", 30, 3, 2, 360, 36000.0),
+    ("01", 20, 0, 1, 360, 36000.0),
+    ("02", 25, 4, 3, 360, 36000.0),
+    ("06", 12, 0, 2, 360, 36000.0),
+    ("16", 15, 0, 1, 360, 36000.0),
+    ("", 30, 0, 1, 12, 1200.0),
+    ("01", 30, 0, 1, 20, 2000.0),
+    ("06", 30, 0, 1, 12, 1200.0),
+]
+ORIGINATION = date(2010, 1, 1)
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def old_loop_rows(code, max_loan_age, delinquent_num, upb_skip, loan_term, original_upb):
+    '''
+    The rows of the month by month loop generate_perf_rows replaced, without its
+    random columns: (reporting month, current_upb, loan_age, delinquency status,
+    loan_payment_history, zero_balance_code) per row and the fields of a terminal row
+    '''
+    kind = LOAN_KINDS.get(code, NON_PERFORMING)
+    has_terminal = kind in (PREPAID, THIRD_PARTY_SALE)
+    delinquent = kind in (CURRENT, THIRD_PARTY_SALE)
+    has_final = not has_terminal and not delinquent
+    reporting_month = add_months(ORIGINATION, 1)
+    monthly_upb = original_upb / loan_term
+    current_upb = original_upb
+    status = 0
+    history = [0] * 24
+    last_payment_date = None
+    rows = []
+    for i in range(max_loan_age - 1 if has_terminal else max_loan_age):
+        final = has_final and i == max_loan_age - 1
+        rows.append((
+            reporting_month,
+            None if upb_skip > 0 or final else max(0, round(current_upb, 1)),
+            None if final else i,
+            "XX" if final else f"{status:02d}",
+            "".join(f"{s:02d}" for s in history) if not has_final else "",
+            code if final else "",
+        ))
+        reporting_month = add_months(reporting_month, 1)
+        loan_term -= 1
+        upb_skip -= 1
+        if upb_skip <= 0:
+            current_upb -= monthly_upb
+        if delinquent and i + delinquent_num + 2 > max_loan_age:
+            if last_payment_date is None:
+                last_payment_date = add_months(reporting_month, -1)
+            status = min(status + 1, 99)
+            current_upb += monthly_upb
+        history = history[1:] + [status]
+        if i > loan_term or current_upb <= 0:
+            break
+    terminal = None
+    if has_terminal:
+        rows.append((reporting_month, 0.0, None, None, None, code))
+        terminal = {'date': reporting_month, 'last_paid_installment_date': last_payment_date}
+    return rows, terminal
+
+
+@pytest.fixture(scope='module')
+def perf_batch():
+    n = len(OUTCOMES)
+    codes, max_loan_age, delinquent_num, upb_skip, loan_term, original_upb = (list(col) for col in zip(*OUTCOMES))
+    loans = pa.RecordBatch.from_pydict({
+        'loan_id': pa.array([f'loan{loan}' for loan in range(n)]),
+        'origination_date': pa.array([ORIGINATION] * n, pa.date32()),
+        'original_loan_term': pa.array(loan_term, pa.int64()),
+        'original_upb': pa.array(original_upb),
+        'original_interest_rate': pa.array([5.0] * n),
+    })
+    outcomes = {
+        'zero_balance_code': np.array(codes, dtype=object),
+        'kind': np.array([LOAN_KINDS.get(code, NON_PERFORMING) for code in codes], dtype=np.int8),
+        'max_loan_age': np.array(max_loan_age),
+        'delinquent_num': np.array(delinquent_num),
+        'msa': np.array(['00000'] * n, dtype=object),
+        'servicer': np.array(['servicer'] * n, dtype=object),
+        'upb_skip': np.array(upb_skip),
+    }
+    return generate_perf_rows(loans, outcomes, PERF_CONF, np.random.default_rng(0))
+
+
+@pytest.fixture(scope='module')
+def perf(perf_batch):
+    return pa.Table.from_batches([perf_batch]).combine_chunks().to_pylist()
+
+
+def test_zero_balance_code_values_are_distinct(perf_batch):
+    # Parquet does not write string dictionaries with duplicates reproducibly
+    values = perf_batch.column('zero_balance_code').dictionary.to_pylist()
+    assert sorted(values) == sorted(set(values)) == ["", "01", "02", "06", "16"]
+
+
+@pytest.mark.parametrize('loan', range(len(OUTCOMES)))
+def test_rows_match_old_loop(perf, loan):
+    code, _, delinquent_num, _, _, _ = OUTCOMES[loan]
+    kind = LOAN_KINDS.get(code, NON_PERFORMING)
+    expected, terminal = old_loop_rows(*OUTCOMES[loan])
+    rows = [row for row in perf if row['loan_id'] == f'loan{loan}']
+    assert len(rows) == len(expected)
+
+    for row, (month, upb, loan_age, status, history, row_code) in zip(rows, expected):
+        assert row['monthly_reporting_period'] == month
+        assert row['current_upb'] == upb
+        assert row['loan_age'] == loan_age
+        assert row['zero_balance_code'] == row_code
+        if status is not None:
+            assert row['current_loan_delinquency_status'] == status
+            assert row['loan_payment_history'] == history
+
+    last = rows[-1]
+    if terminal is None:
+        if expected[-1][-1]:
+            assert last['zero_balance_effective_date'] == last['monthly_reporting_period']
+            assert last['repurchase_make_whole_proceeds_flag'] == ('Y' if kind == REPURCHASED else 'N')
+        else:
+            assert last['zero_balance_effective_date'] is None
+        return
+    # the extra row after the monthly ones
+    assert last['zero_balance_effective_date'] == terminal['date']
+    assert last['loan_payment_history'] is None
+    assert last['servicer_name'] is None
+    assert last['remaining_months_to_legal_maturity'] is None
+    assert last['repurchase_make_whole_proceeds_flag'] == 'N'
+    if kind == PREPAID:
+        assert last['current_loan_delinquency_status'] in ('XX', '00')
+        assert last['current_interest_rate'] is None
+        assert last['foreclosure_date'] is None
+        assert all(last[col] is None for col in terminal_normal_cols)
+    else:
+        assert last['current_loan_delinquency_status'] in ('XX', f'{delinquent_num:02d}')
+        assert last['current_interest_rate'] == 5.0
+        assert last['last_paid_installment_date'] == terminal['last_paid_installment_date']
+        assert last['foreclosure_date'] == last['disposition_date'] == terminal['date']
+        assert all(0 <= last[col] <= 1000 for col in terminal_normal_cols)
@@ -0,0 +1,26 @@
+import math
+
+import numpy as np
+import pytest
+
+from utils import truncated_normal
+
+
+@pytest.mark.parametrize('min_val, max_val', [
+    (0, 10),
+    (8, 9),
+    (-50, -40),
+    (math.nan, 10),
+    (0, math.nan),
+    (math.nan, math.nan),
+])
+def test_truncated_normal_bounds(min_val, max_val):
+    values = truncated_normal(5, 3, min_val, max_val, 10000, np.random.default_rng(0))
+    assert not np.isnan(values).any()
+    assert values.min() >= (-math.inf if math.isnan(min_val) else min_val)
+    assert values.max() <= (math.inf if math.isnan(max_val) else max_val)
+
+
+def test_truncated_normal_without_std_is_the_mean():
+    values = truncated_normal(5, math.nan, 0, 10, 3, np.random.default_rng(0))
+    assert values.tolist() == [5, 5, 5]
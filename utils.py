@@ -1,7 +1,10 @@
-import random
 import math
 import numpy as np
 import pyarrow as pa
+import pyarrow.compute as pc
+
+from bisect import bisect
+from functools import cached_property
 
 data_types = {
  'original_upb': 'int',
@@ -173,27 +176,391 @@ acq_schema = pa.schema([
 ])
 
 
-def get_random_choice(candidates_weights):
+# Columns kept dictionary or run-end encoded in memory. The perf values that are
+# constant for a loan are emitted once per loan, constant columns as a single run
+perf_encodings = {
+    'loan_id': 'dictionary',
+    'servicer_name': 'dictionary',
+    'master_servicer': 'run_end',
+    'current_interest_rate': 'dictionary',
+    'maturity_date': 'dictionary',
+    'msa': 'dictionary',
+    'current_loan_delinquency_status': 'dictionary',
+    'loan_payment_history': 'dictionary',
+    'modification_flag': 'dictionary',
+    'mortgage_insurance_cancellation_flag': 'run_end',
+    'zero_balance_code': 'dictionary',
+    'repurchase_make_whole_proceeds_flag': 'dictionary',
+}
+
+acq_encodings = {
+    'channel': 'dictionary',
+    'seller_name': 'dictionary',
+    'first_time_buyer': 'dictionary',
+    'loan_purpose': 'dictionary',
+    'property_type': 'dictionary',
+    'occupancy_status': 'dictionary',
+    'property_state': 'dictionary',
+    'relocation_mortgage_indicator': 'dictionary',
+}
+
+
+def encode_schema(schema, encodings):
+    fields = []
+    for field in schema:
+        if encodings.get(field.name) == 'dictionary':
+            field = field.with_type(pa.dictionary(pa.int32(), field.type))
+        elif encodings.get(field.name) == 'run_end':
+            field = field.with_type(pa.run_end_encoded(pa.int32(), field.type))
+        fields.append(field)
+    return pa.schema(fields)
+
+
+encoded_perf_schema = encode_schema(perf_schema, perf_encodings)
+encoded_acq_schema = encode_schema(acq_schema, acq_encodings)
+
+
+def combined_schema(perf_schema, acq_schema):
+    '''
+    Schema of the perf rows with the acq columns of their loan appended as dictionaries
+    '''
+    fields = list(perf_schema)
+    for field in acq_schema:
+        if field.name == 'loan_id':
+            continue
+        value_type = field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+        fields.append(field.with_type(pa.dictionary(pa.int32(), value_type)))
+    return pa.schema(fields)
+
+
+# loan_id modes: uuid4 strings, or a partition prefixed counter as int64 or as
+# 12 digit strings like the Fannie Mae ids. The prefix is the partition's
+# year * 10 + quarter followed by LOAN_ID_COUNTER_DIGITS[mode] counter digits:
+# 13 fill most of the int64 range, 7 the 12 digits of fixed. uuid ids have no
+# counter, its digits only number the loans of a partition
+LOAN_ID_TYPES = {
+    'uuid': pa.string(),
+    'int': pa.int64(),
+    'fixed': pa.string(),
+}
+LOAN_ID_COUNTER_DIGITS = {
+    'uuid': 13,
+    'int': 13,
+    'fixed': 7,
+}
+
+
+def max_partition_loans(loan_id_mode):
+    '''
+    Loans a partition can have with loan_id_mode before its counter overflows
+    '''
+    return 10 ** LOAN_ID_COUNTER_DIGITS[loan_id_mode]
+
+
+def loan_id_base(partition, loan_id_mode='uuid'):
+    '''
+    First loan id of a partition like 2000Q1
+    '''
+    year, quarter = partition.split('Q')
+    return (int(year) * 10 + int(quarter)) * max_partition_loans(loan_id_mode)
+
+
+# the hex digits of a byte value and the positions of the 32 digits of a uuid string
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+UUID_DIGIT_POSITIONS = np.array([i for i in range(36) if i not in (8, 13, 18, 23)])
+
+
+def uuid4_strings(rng, n):
+    '''
+    n version 4 uuids of random bytes drawn from rng, as the same strings
+    str(UUID(bytes=rng.bytes(16), version=4)) gives, built directly as a fixed
+    width 36 character Arrow string array
+    '''
+    raw = np.frombuffer(rng.bytes(16 * n), dtype=np.uint8).reshape(n, 16).copy()
+    raw[:, 6] = raw[:, 6] & 0x0F | 0x40
+    raw[:, 8] = raw[:, 8] & 0x3F | 0x80
+    digits = np.empty((n, 32), dtype=np.uint8)
+    digits[:, 0::2] = HEX_DIGITS[raw >> 4]
+    digits[:, 1::2] = HEX_DIGITS[raw & 0x0F]
+    data = np.full((n, 36), ord('-'), dtype=np.uint8)
+    data[:, UUID_DIGIT_POSITIONS] = digits
+    offsets = np.arange(n + 1, dtype=np.int32) * 36
+    return pa.Array.from_buffers(pa.string(), n, [None, pa.py_buffer(offsets), pa.py_buffer(data.tobytes())])
+
+
+def generate_loan_ids(first_loan_num, n, loan_id_mode='uuid', rng=None):
+    '''
+    loan_id of n loans, counting up from the partition prefixed first_loan_num,
+    or version 4 uuids of random bytes drawn from rng
+    '''
+    if loan_id_mode == 'uuid':
+        return uuid4_strings(np.random.default_rng(rng), n)
+    max_loans = max_partition_loans(loan_id_mode)
+    if first_loan_num % max_loans + n > max_loans:
+        raise ValueError(f"more than {max_loans} loans in a partition for loan_id_mode {loan_id_mode}")
+    loan_ids = pa.array(np.arange(first_loan_num, first_loan_num + n, dtype=np.int64))
+    return loan_ids.cast(LOAN_ID_TYPES[loan_id_mode])
+
+
+def with_loan_id_type(schema, loan_id_type):
+    '''
+    schema with loan_id of loan_id_type, keeping its dictionary encoding
+    '''
+    idx = schema.get_field_index('loan_id')
+    field = schema.field(idx)
+    if pa.types.is_dictionary(field.type):
+        loan_id_type = pa.dictionary(field.type.index_type, loan_id_type)
+    return schema.set(idx, field.with_type(loan_id_type))
+
+
+def dictionary_array(values, indices, nulls=None):
+    '''
+    DictionaryArray of indices into values, rows in nulls are set to null
+    '''
+    if not isinstance(values, pa.Array):
+        values = pa.array(values, type=pa.string())
+    return pa.DictionaryArray.from_arrays(pa.array(indices, mask=nulls, type=pa.int32()), values)
+
+
+def run_end_constant(value, length, value_type):
+    '''
+    A column of length rows that all hold value, as a single run
+    '''
+    run_ends = [length] if length else []
+    values = [value] if length else []
+    return pa.RunEndEncodedArray.from_arrays(pa.array(run_ends, type=pa.int32()), pa.array(values, type=value_type))
+
+
+def conform(array, field_type):
+    '''
+    Cast a generated column to its (encoded) schema type
+    '''
+    if array.type == field_type:
+        return array
+    if pa.types.is_dictionary(field_type) and not pa.types.is_dictionary(array.type):
+        return array.cast(field_type.value_type).dictionary_encode()
+    if pa.types.is_dictionary(array.type) and not pa.types.is_dictionary(field_type):
+        return array.dictionary_decode().cast(field_type)
+    return array.cast(field_type)
+
+
+def decode_run_end(table):
+    '''
+    Replace run-end encoded columns by their plain values, for writers without
+    run-end encoding support such as Parquet
+    '''
+    for i, field in enumerate(table.schema):
+        if pa.types.is_run_end_encoded(field.type):
+            table = table.set_column(i, field.with_type(field.type.value_type), pc.run_end_decode(table.column(i)))
+    return table
+
+
+def decoded_schema(schema):
+    '''
+    The schema of decode_columns(table) for a table of schema
+    '''
+    fields = []
+    for field in schema:
+        if pa.types.is_run_end_encoded(field.type) or pa.types.is_dictionary(field.type):
+            field = field.with_type(field.type.value_type)
+        fields.append(field)
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+def decode_columns(table):
+    '''
+    Replace run-end and dictionary encoded columns by their plain values, for
+    formats that need the same types in every batch such as ORC, CSV and Arrow IPC
+    files, which cannot replace a dictionary between batches
+    '''
+    table = decode_run_end(table)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.with_type(field.type.value_type), table.column(i).cast(field.type.value_type))
+    return table
+
+
+def group_by_value(array):
+    '''
+    group_indices of an Arrow array by value, yields (value, rows)
+    '''
+    if not pa.types.is_dictionary(array.type):
+        array = array.dictionary_encode()
+    values = array.dictionary.to_pylist()
+    for idx, rows in group_indices(array.indices.fill_null(-1).to_numpy()):
+        yield (values[idx] if idx >= 0 else None), rows
+
+
+# Dates are tracked as month indices, year * 12 + month - 1, and turned into
+# date32 days since epoch with this lookup of first-of-month days
+FIRST_MONTH_INDEX = 1900 * 12
+MONTH_EPOCH_DAYS = (np.arange(FIRST_MONTH_INDEX, 2200 * 12) - 1970 * 12).astype('datetime64[M]').astype('datetime64[D]').astype(np.int32)
+
+
+def month_index(year, month):
+    return year * 12 + month - 1
+
+
+def month_index_to_date32(months, nulls=None):
+    '''
+    First day of each month index as a date32 Arrow array, rows in nulls are set to null
+    '''
+    months = np.asarray(months)
+    if nulls is not None:
+        months = np.where(nulls, FIRST_MONTH_INDEX, months)
+    days = MONTH_EPOCH_DAYS[months - FIRST_MONTH_INDEX]
+    return pa.array(days, mask=nulls).view(pa.date32())
+
+
+def date32_to_month_index(dates):
+    '''
+    Month index of every date of a date32 Arrow array
+    '''
+    days = dates.fill_null(0).view(pa.int32()).to_numpy()
+    return np.searchsorted(MONTH_EPOCH_DAYS, days, side='right') - 1 + FIRST_MONTH_INDEX
+
+
+class WeightedChoice:
+    '''
+    A {value: weight} distribution from acq.json / perf.json compiled once into a
+    cumulative-weight table, so drawing does not rebuild the key and weight lists.
+    "NaN" values are returned as "0".
+
+    convert is applied once to every value at compile time, values_array holds the
+    converted values as a numpy array of the given dtype for batch draws.
+
+    Tables read by compile_config keep their values as an Arrow array over the
+    memory mapped file and only convert them to values_array on the first draw.
+    arrow_values holds the values as an Arrow array, e.g. as a dictionary for
+    indices drawn with sample_indices.
+
+    Draws take the np.random.Generator rng they are drawn from.
+    '''
+
+    def __init__(self, candidates_weights, convert=None, dtype=object):
+        values = ["0" if val == "NaN" else val for val in candidates_weights.keys()]
+        values = [convert(val) for val in values] if convert else values
+        self.values_array = np.array(values, dtype=dtype)
+        self.cum_weights = np.cumsum(np.asarray(list(candidates_weights.values()), dtype=np.float64))
+        self.total = float(self.cum_weights[-1]) if len(values) else 0.0
+
+    @classmethod
+    def from_arrays(cls, values_array, cum_weights, offset=0):
+        '''
+        A WeightedChoice of already compiled arrays, as stored by compile_config.
+        values_array may be an Arrow array holding the values from offset on,
+        converted when first needed
+        '''
+        weighted_choice = cls.__new__(cls)
+        if isinstance(values_array, pa.Array):
+            weighted_choice._arrow_values = (values_array, offset)
+        else:
+            weighted_choice.values_array = values_array
+        weighted_choice.cum_weights = cum_weights
+        weighted_choice.total = float(cum_weights[-1]) if len(cum_weights) else 0.0
+        return weighted_choice
+
+    @cached_property
+    def values_array(self):
+        return self.arrow_values.to_numpy(zero_copy_only=False)
+
+    @cached_property
+    def arrow_values(self):
+        if '_arrow_values' in self.__dict__:
+            values, offset = self._arrow_values
+            return values.slice(offset, len(self))
+        return pa.array(self.values_array)
+
+    @cached_property
+    def values(self):
+        return self.values_array.tolist()
+
+    @cached_property
+    def _cum_weights_list(self):
+        return self.cum_weights.tolist()
+
+    def __len__(self):
+        return len(self.cum_weights)
+
+    def choice(self, rng):
+        hi = len(self) - 1
+        return self.values[bisect(self._cum_weights_list, rng.random() * self.total, 0, hi)]
+
+    def sample_indices(self, n, rng):
+        idx = np.searchsorted(self.cum_weights, rng.random(n) * self.total, side='right')
+        return np.minimum(idx, len(self) - 1)
+
+    def choices(self, n, rng):
+        return self.values_array[self.sample_indices(n, rng)]
+
+
+def group_indices(keys):
+    '''
+    Split row positions by key, yields (key, rows) for every distinct key.
+    Rows keep their original order inside a group.
+    '''
+    uniques, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    starts = np.searchsorted(inverse[order], np.arange(1, len(uniques)))
+    return zip(uniques, np.split(order, starts))
+
+
+# Acklam's rational approximation of the standard normal inverse CDF (rel. error < 1.2e-9)
+_PPF_A = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+          1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+_PPF_B = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+          6.680131188771972e+01, -1.328068155288572e+01]
+_PPF_C = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+          -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+_PPF_D = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+          3.754408661907416e+00]
+_PPF_P_LOW = 0.02425
+
+
+def norm_ppf(p):
+    p = np.asarray(p, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # central region
+        q = p - 0.5
+        r = q * q
+        x = q * np.polyval(_PPF_A, r) / np.polyval(_PPF_B + [1.0], r)
+        # tails, the upper one by symmetry
+        tail = np.minimum(p, 1 - p)
+        q = np.sqrt(-2 * np.log(tail))
+        x_tail = np.polyval(_PPF_C, q) / np.polyval(_PPF_D + [1.0], q)
+        x = np.where(tail < _PPF_P_LOW, np.where(p < 0.5, x_tail, -x_tail), x)
+    return x
+
+
+def norm_cdf(z):
+    return 0.5 * math.erfc(-z / math.sqrt(2))
+
 
-    val =  random.choices(list(candidates_weights.keys()), list(candidates_weights.values()))[0]
-    if val == "NaN":
-        return "0"
-    else:
-        return val
+def truncated_normal(mean, std, min_val, max_val, n, rng):
+    '''
+    Draw n values of N(mean, std) truncated to [min_val, max_val] from the
+    np.random.Generator rng, rounded to 3 decimals.
 
-def get_random_choices_with_range(candidates_weights, min_val = float('-inf'), max_val = float('inf')):
+    Inverse-CDF sampling: uniforms between the CDF of both bounds are mapped back through
+    the normal PPF, so the cost is the same no matter how close the bounds are to the mean.
+    A NaN or zero std returns the mean, like the old rejection loop did. A NaN bound
+    is no bound.
+    '''
+    if not std or math.isnan(std):
+        return np.full(n, mean, dtype=np.float64)
 
-    while True:
-        random_value = random.choices(list(candidates_weights.keys()), list(candidates_weights.values()))[0]
-        if min_val <= random_value <= max_val:
-            return round(random_value, 3)
-        
-def generate_random_within_range(mean, std, min_val, max_val):
+    min_val = -math.inf if math.isnan(min_val) else min_val
+    max_val = math.inf if math.isnan(max_val) else max_val
+    lo = (min_val - mean) / std
+    hi = (max_val - mean) / std
+    # sample the upper tail as a mirrored lower tail, the CDF is only precise close to 0
+    flip = lo > 0
+    if flip:
+        lo, hi = -hi, -lo
 
-    while True:
-        if not std or math.isnan(std):
-            return mean
-        random_value = np.random.normal(loc=mean, scale=std)
-        if min_val <= float(random_value) <= max_val:
-            return round(random_value, 3)
-        
\ No newline at end of file
+    # bounds far enough in the tail for the CDF to underflow collapse onto the bound
+    u = np.maximum(rng.uniform(norm_cdf(lo), norm_cdf(hi), n), np.finfo(np.float64).tiny)
+    z = norm_ppf(u)
+    if flip:
+        z = -z
+    return np.round(np.clip(mean + std * z, min_val, max_val), 3)